@@ -1,13 +1,22 @@
+import glob
 import os
+import shutil
 import polars as pl
 from tqdm import tqdm
 import heapq
 import time
 
-def aggregate_df(df):
+from voicings.core.governor import MemoryGovernor
+from voicings.core.intern import VoicingDictionary
+
+# single read of the fragments for the tournament and refuse steps;
+# False for the original two passes.
+FUSED = True
+
+def aggregate_df(df, key="notes"):
     if 'fname' in df.columns:
         return (
-            df.group_by("notes")
+            df.group_by(key)
             .agg(
                 pl.col("duration").sum().alias("duration"),
                 pl.col("fname").n_unique().alias("frequency")
@@ -15,7 +24,7 @@ def aggregate_df(df):
         )
     else:
         return (
-            df.group_by("notes")
+            df.group_by(key)
             .agg(
                 pl.col("duration").sum().alias("duration"),
                 pl.col("frequency").sum().alias("frequency")
@@ -28,12 +37,33 @@ def prune_df(df, min_freq=2, top_k=None):
         good = df.filter(pl.col("frequency") >= min_freq)
         bad = df.filter(pl.col("frequency") < min_freq)
         return good, bad
+    if not top_k:
+        # no pruning: everything is good
+        return df, df.clear()
     # if top_k:
     #     df = df.sort("frequency", descending=True).head(top_k)
     # return df
 
 
-def tournament_merge(input_dir, prune_min_freq=2, prune_top_k=None, *, chunks=None):
+def tournament_merge(
+        input_dir,
+        prune_min_freq=2,
+        prune_top_k=None,
+        *,
+        chunks=None,
+        postings=None,
+        key="notes",
+        fan_in=2,
+        memory_budget=None,
+    ):
+    """
+    Aggregate every fragment in input_dir, keep the good part, and merge fan_in tables at a time.
+    key is the group-by key (a column name or list of names).
+    With memory_budget, fan_in is chosen every round from the size of the largest table
+    (see core/governor.py): many small tables are merged at once, big ones pairwise.
+    If postings (an inverted_index.PostingsCollector) is given, each fragment is also
+    indexed while it is in memory.
+    """
     start_time = time.time()
     
     if input_dir is not None:
@@ -48,7 +78,9 @@ def tournament_merge(input_dir, prune_min_freq=2, prune_top_k=None, *, chunks=No
         chunks = []
         for path in tqdm(files, desc="Initial aggregation"):
             df = pl.read_parquet(path)
-            agg = aggregate_df(df)
+            if postings is not None:
+                postings.add_fragment(df)
+            agg = aggregate_df(df, key)
             good, bad = prune_df(agg, prune_min_freq, prune_top_k)
             chunks.append(good)
         
@@ -61,22 +93,26 @@ def tournament_merge(input_dir, prune_min_freq=2, prune_top_k=None, *, chunks=No
 
 
     # Merge tournament-style
+    governor = MemoryGovernor(memory_budget) if memory_budget is not None else None
     tournament_start = time.time()
     round_num = 1
     while len(chunks) > 1:
         round_start = time.time()
+        if governor is not None:
+            fan_in = governor.fan_in(max(chunk.estimated_size() for chunk in chunks))
         new_chunks = []
-        for i in range(0, len(chunks), 2):
-            if i + 1 < len(chunks):
-                merged = pl.concat([chunks[i], chunks[i+1]], how="vertical")
-                merged = aggregate_df(merged)
+        for i in range(0, len(chunks), fan_in):
+            group = chunks[i:i + fan_in]
+            if len(group) > 1:
+                merged = pl.concat(group, how="vertical")
+                merged = aggregate_df(merged, key)
                 # merged = prune_df(merged, None, prune_top_k)
                 new_chunks.append(merged)
             else:
-                new_chunks.append(chunks[i])  # carry forward odd chunk
+                new_chunks.append(group[0])  # carry forward odd chunk
         chunks = new_chunks
         round_time = time.time() - round_start
-        print(f"Round {round_num}: {len(chunks)} tables remaining (took {round_time:.2f}s)")
+        print(f"Round {round_num}: {len(chunks)} tables remaining (fan-in {fan_in}, took {round_time:.2f}s)")
         round_num += 1
     
     tournament_time = time.time() - tournament_start
@@ -90,7 +126,86 @@ def tournament_merge(input_dir, prune_min_freq=2, prune_top_k=None, *, chunks=No
     return final
 
 
-def dig_through_refuse_for_misses(input_dir, good_df: pl.DataFrame, prune_min_freq=2):
+def _bucket_expr(key, n_partitions):
+    # every copy of a key lands in the same partition
+    return (pl.struct(key).hash(seed=0) % n_partitions).alias("_bucket")
+
+
+def fused_tournament_and_refuse(
+        input_dir="data/fragments",
+        prune_min_freq=2,
+        key="notes",
+        output_dir="data/chords",
+        n_partitions=64,
+        postings=None,
+        memory_budget=None,
+    ):
+    """
+    main_tournament_step and main_refuse_step in one read of the fragments.
+    Each fragment is read and aggregated once: the good part goes to the tournament,
+    the bad part is spilled to n_partitions partitions by key hash.
+    Then each partition is split against the matching partition of the final good table
+    (same outputs as dig_through_refuse_for_misses), without touching the fragments again.
+    """
+    spill_dir = f"{output_dir}/refuse_spill"
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    os.makedirs(spill_dir)
+
+    files = [os.path.join(input_dir, f)
+             for f in os.listdir(input_dir) if f.endswith(".parquet")]
+    print(f"Found {len(files)} parquet files to process")
+    if not files:
+        # nothing to aggregate, and no fragment to take the outputs' schema from
+        shutil.rmtree(spill_dir)
+        print("No fragments; nothing written.")
+        return
+
+    chunks = []
+    for i, path in enumerate(tqdm(files, desc="Aggregating fragments")):
+        df = pl.read_parquet(path)
+        if postings is not None:
+            postings.add_fragment(df)
+        good, bad = prune_df(aggregate_df(df, key), prune_min_freq, None)
+        chunks.append(good)
+        empty = bad.clear()
+        for (bucket,), rows in bad.with_columns(_bucket_expr(key, n_partitions)).partition_by(
+                "_bucket", include_key=False, as_dict=True).items():
+            rows.write_parquet(f"{spill_dir}/part_{bucket}_{i}.parquet")
+
+    final_df = tournament_merge(None, chunks=chunks, key=key, memory_budget=memory_budget)
+    del chunks
+    final_df.write_parquet(f"{output_dir}/summary_tournament.parquet")
+
+    good_parts = final_df.select(key).with_columns(_bucket_expr(key, n_partitions)).partition_by(
+        "_bucket", include_key=False, as_dict=True)
+    del final_df
+    for bucket in tqdm(range(n_partitions), desc="Processing refuse (uncommon fragments)"):
+        files = glob.glob(f"{spill_dir}/part_{bucket}_*.parquet")
+        if not files:
+            continue
+        bad = pl.read_parquet(files)
+        good_df = good_parts.get((bucket,), bad.select(key).clear())
+        bad.join(good_df, on=key, how='semi').write_parquet(f"{spill_dir}/misses_{bucket}.parquet")
+        very_bad = bad.join(good_df, on=key, how='anti').group_by(key).agg(
+            pl.col("duration").sum().alias("duration"),
+            pl.col("frequency").sum().alias("frequency")
+        )
+        very_bad.write_parquet(f"{spill_dir}/very_bad_{bucket}.parquet")
+
+    if not glob.glob(f"{spill_dir}/very_bad_*.parquet"):
+        # nothing was pruned anywhere
+        empty.write_parquet(f"{spill_dir}/very_bad_empty.parquet")
+        empty.write_parquet(f"{spill_dir}/misses_empty.parquet")
+    print("Writing refuse fragments to file...")
+    pl.scan_parquet(f"{spill_dir}/very_bad_*.parquet").sort("duration", descending=True).sink_parquet(
+        f"{output_dir}/frequent_refuse.parquet")
+    print("Writing infrequent refuse fragments to file...")
+    pl.scan_parquet(f"{spill_dir}/misses_*.parquet").sink_parquet(f"{output_dir}/infrequent_refuse.parquet")
+    shutil.rmtree(spill_dir)
+    print("Done")
+
+
+def dig_through_refuse_for_misses(input_dir, good_df: pl.DataFrame, prune_min_freq=2, key="notes"):
     refuse = []
     all_misses = []
     files = [os.path.join(input_dir, f) 
@@ -98,16 +213,16 @@ def dig_through_refuse_for_misses(input_dir, good_df: pl.DataFrame, prune_min_fr
     
     for path in tqdm(files, desc="Processing refuse (uncommon fragments)"):
         df = pl.read_parquet(path)
-        agg = aggregate_df(df)
+        agg = aggregate_df(df, key)
         good, bad = prune_df(agg, prune_min_freq, None)
         misses = bad.join(
             good_df,
-            on='notes',
+            on=key,
             how='semi'
         )
         very_bad = bad.join(
             good_df,
-            on='notes',
+            on=key,
             how='anti'
         )
         refuse.append(very_bad)
@@ -116,7 +231,7 @@ def dig_through_refuse_for_misses(input_dir, good_df: pl.DataFrame, prune_min_fr
     print("Combining refuse fragments...")
     frequent_refuse = pl.concat(refuse, how="vertical")
     print("Grouping refuse fragments...")
-    frequent_refuse = frequent_refuse.group_by("notes").agg(
+    frequent_refuse = frequent_refuse.group_by(key).agg(
         pl.col("duration").sum().alias("duration"),
         pl.col("frequency").sum().alias("frequency")
     )
@@ -131,12 +246,31 @@ def dig_through_refuse_for_misses(input_dir, good_df: pl.DataFrame, prune_min_fr
     print("Done")
 
 
-def main_tournament_step():
+def intern_fragments(input_dir="data/fragments", output_dir="data/fragments_interned", dictionary=None):
+    """
+    Rewrite fragments as (fname, voicing_id, duration), assigning ids to new voicings.
+    The later steps then group and join on a UInt32 instead of a list;
+    notes are decoded only at presentation time (step3).
+    """
+    if dictionary is None:
+        dictionary = VoicingDictionary()
+    os.makedirs(output_dir, exist_ok=True)
+    files = [f for f in os.listdir(input_dir) if f.endswith(".parquet")]
+    for fname in tqdm(files, desc="Interning voicings"):
+        df = pl.read_parquet(os.path.join(input_dir, fname))
+        df = dictionary.assign(df).drop('notes')
+        df.write_parquet(os.path.join(output_dir, fname))
+    dictionary.flush()
+    print(f"Dictionary holds {len(dictionary)} voicings.")
+    return dictionary
+
+
+def main_tournament_step(input_dir="data/fragments", key="notes", memory_budget=None):
     
     print("Starting tournament merge...")
     tournament_start = time.time()
     
-    final_df = tournament_merge("data/fragments", prune_min_freq=2, prune_top_k=None)
+    final_df = tournament_merge(input_dir, prune_min_freq=2, prune_top_k=None, key=key, memory_budget=memory_budget)
     print("Tournament done.")
     
     write_start = time.time()
@@ -148,7 +282,7 @@ def main_tournament_step():
     print(f"Tournament merge took: {tournament_time:.2f} seconds")
 
 
-def main_refuse_step():
+def main_refuse_step(input_dir="data/fragments", key="notes"):
     print("Trying to read files...")
     best = pl.read_parquet("data/chords/summary_tournament.parquet")
     # Load frequent people from a file or define them
@@ -156,8 +290,9 @@ def main_refuse_step():
     print("File read complete.")
     dedup_start = time.time()
     dig_through_refuse_for_misses(
-        "data/fragments",
-        best
+        input_dir,
+        best,
+        key=key
     )
     dedup_time = time.time() - dedup_start
     print(f"Deduplication took: {dedup_time:.2f} seconds")
@@ -168,12 +303,21 @@ if __name__ == "__main__":
 
     overall_start = time.time()
 
-    # produces data/chords/summary_tournament.parquet
-    main_tournament_step()
+    # to work on voicing ids instead of notes lists:
+    # intern_fragments("data/fragments", "data/fragments_interned")
+    # and pass input_dir="data/fragments_interned", key="voicing_id" below
+    # (and key="voicing_id" to the cyclic and finalize steps)
+
+    if FUSED:
+        # one read of the fragments; same three outputs as below
+        fused_tournament_and_refuse(memory_budget="16GiB")
+    else:
+        # produces data/chords/summary_tournament.parquet
+        main_tournament_step()
 
-    # produces data/chords/frequent_refuse.parquet
-    # produces data/chords/infrequent_refuse.parquet
-    main_refuse_step()
+        # produces data/chords/frequent_refuse.parquet
+        # produces data/chords/infrequent_refuse.parquet
+        main_refuse_step()
 
     # naively trying to aggregate infrequent_refuse is too slow -- even with duckdb!
     # NOTE: for a smart way to aggregate 
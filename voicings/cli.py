@@ -0,0 +1,134 @@
+# Command line lookups against the static export (see step5_encipher.desperate_measures):
+#   voicings lookup 37              a voicing by digest
+#   voicings lookup --notes 60 64 67 71
+#   voicings lookup --pcid 145      a pitch-class set, with its most frequent voicings
+
+# Only the standard library and the pure-Python parts of core are imported (no polars, no tqdm),
+# so a lookup starts in well under 100ms. Shards are read with csv; {pcid}.csv.gz is used when
+# only the compressed shard was downloaded.
+
+import argparse
+import csv
+import json
+import os
+
+from voicings.core.decipher import int_to_note_name
+from voicings.core.encipher import pack_notes, pcid_of_notes, unpack_notes, unpack_pitch_class
+from voicings.core.feasible import is_feasible
+
+EXPORT_DIR = "data/chords/grouped"
+PCID_TABLE = "data/chords/export/most_popular_cls_packed.csv"
+
+
+def _read_csv(path):
+    if os.path.exists(path):
+        with open(path, newline='') as f:
+            return list(csv.DictReader(f))
+    if os.path.exists(path + ".gz"):
+        import gzip
+        with gzip.open(path + ".gz", 'rt', newline='') as f:
+            return list(csv.DictReader(f))
+    return None
+
+
+def _counts(row):
+    return {'frequency': int(row['frequency']), 'duration': float(row['duration'])}
+
+
+def _names(notes):
+    return " ".join(int_to_note_name(n, octave=False) for n in notes)
+
+
+def lookup_digest(digest: str, export_dir=EXPORT_DIR) -> dict:
+    """
+    The voicing with this digest (notes relative to the bass), and its counts if it was exported.
+    """
+    notes = unpack_notes(digest)
+    pcid = pcid_of_notes(notes)
+    result = {
+        'digest': digest,
+        'rel': notes,
+        'names': _names(notes),
+        'pcid': pcid,
+        'feasible': is_feasible(notes),
+        'frequency': None,
+        'duration': None,
+    }
+    shard = _read_csv(os.path.join(export_dir, f"{pcid}.csv")) or []
+    for row in shard:
+        if row['digest'] == digest:
+            result.update(_counts(row))
+            break
+    return result
+
+
+def lookup_pcid(pcid: int, export_dir=EXPORT_DIR, pcid_table=PCID_TABLE, top=10) -> dict:
+    """
+    The pitch-class set with this PCID, its counts, and its top voicings by frequency.
+    """
+    cls = unpack_pitch_class(pcid)
+    result = {
+        'pcid': pcid,
+        'cls': cls,
+        'names': _names(cls),
+        'frequency': None,
+        'duration': None,
+        'n_voicings': 0,
+        'voicings': [],
+    }
+    for row in _read_csv(pcid_table) or []:
+        if int(row['pcid']) == pcid:
+            result.update(_counts(row))
+            break
+    shard = _read_csv(os.path.join(export_dir, f"{pcid}.csv")) or []
+    shard.sort(key=lambda row: -int(row['frequency']))
+    result['n_voicings'] = len(shard)
+    result['voicings'] = [
+        {'digest': row['digest'], 'names': _names(unpack_notes(row['digest'])), **_counts(row)}
+        for row in shard[:top]
+    ]
+    return result
+
+
+def _print(result):
+    for key, value in result.items():
+        if key != 'voicings':
+            print(f"{key:>10}: {'-' if value is None else value}")
+    for row in result.get('voicings', []):
+        print(f"  {row['digest']:<12} {row['names']:<24} {row['frequency']:>10} {row['duration']:>14.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="voicings")
+    commands = parser.add_subparsers(dest='command', required=True)
+    lookup = commands.add_parser('lookup', help="look up a voicing or pitch-class set in the export")
+    query = lookup.add_mutually_exclusive_group(required=True)
+    query.add_argument('digest', nargs='?', help="voicing digest, e.g. 37")
+    query.add_argument('--pcid', type=int, help="pitch-class set ID (0-2047)")
+    query.add_argument('--notes', type=int, nargs='+', help="MIDI notes of a voicing, e.g. 60 64 67")
+    lookup.add_argument('--export-dir', default=EXPORT_DIR)
+    lookup.add_argument('--pcid-table', default=PCID_TABLE)
+    lookup.add_argument('--top', type=int, default=10, help="voicings to list for --pcid")
+    lookup.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.pcid is not None:
+            result = lookup_pcid(args.pcid, args.export_dir, args.pcid_table, args.top)
+        else:
+            digest = pack_notes(sorted(set(args.notes))) if args.notes else args.digest
+            if digest is None:
+                parser.error("a gap between notes is too large for a digest")
+            result = lookup_digest(digest, args.export_dir)
+    except ValueError as e:
+        # PCID out of range, or a character that is not in the digest alphabet
+        parser.error(str(e))
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        _print(result)
+
+
+if __name__ == "__main__":
+    main()
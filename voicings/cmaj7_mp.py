@@ -1,18 +1,48 @@
 import os
 import glob
 import multiprocessing as mp
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import polars as pl
 from symusic import Score
 from voicings.core.chords import all_chords_for_score
+from voicings.core.fragment_builder import FragmentBuilder
+from voicings.core.governor import MemoryGovernor
+from voicings.core.heavy_hitters import HeavyHitters
+from voicings.core.ngrams import file_transitions
+from voicings.core.pcid_histogram import PcidHistogram
+from voicings.core.sampling import stratified_sample
+from voicings.core.watchdog import run_with_watchdog
+from voicings.dedup_inputs import canonical_files
 
 
-def process_midi_file(file_path):
+class IngestionCancelled(Exception):
+    """
+    keep_going (see collect_chords_directory_parallel) returned False; the rest was abandoned.
+    """
+
+
+def process_midi_file(file_path, extract_options=None):
+    # per-file costs; process_batch keeps them if telemetry is on
+    telemetry = {'bytes': None, 'parse_s': None, 'extract_s': None, 'n_notes': None, 'n_chords': None}
     try:
         with open(file_path, 'rb') as f:
             midi_bytes = f.read()
+        telemetry['bytes'] = len(midi_bytes)
+        t0 = time.perf_counter()
         score = Score.from_midi(midi_bytes)
-        chords = all_chords_for_score(score)
+        t1 = time.perf_counter()
+        chords = all_chords_for_score(score, **(extract_options or {}))
+        t2 = time.perf_counter()
+        telemetry.update(
+            parse_s=t1 - t0,
+            extract_s=t2 - t1,
+            n_notes=sum(len(track.notes) for track in score.tracks),
+            n_chords=len(chords),
+        )
         chords = [c for c in chords if len(c.notes) >= 3]
 
         collector = {
@@ -26,28 +56,113 @@ def process_midi_file(file_path):
             collector['notes'].append(chord.notes)
             collector['duration'].append(chord.duration)
 
+        collector['error'] = None
+        collector['telemetry'] = telemetry
         return collector
 
     except Exception as e:
-        # print(f"Error processing {file_path}: {e}")
+        # no rows; the error goes to the quarantine table instead
         return {
-            'fname': [file_path],
-            'notes': [None],
-            'duration': [None],
+            'fname': [],
+            'notes': [],
+            'duration': [],
+            'error': f"{type(e).__name__}: {e}",
+            'telemetry': telemetry,
         }
 
 
-def process_batch(batch_id, midi_files, aggregate_mode=True, output_dir="data/fragments"):
+def process_batch(
+    batch_id,
+    midi_files,
+    aggregate_mode=True,
+    output_dir="data/fragments",
+    heavy_hitters=None,
+    transitions=False,
+    voicing_vocab=None,
+    transitions_dir="data/transitions",
+    telemetry=False,
+    telemetry_dir="data/telemetry",
+    extract_options=None,
+    pcid_histogram=False,
+    on_file_start=None,
+):
+    """
+    Process a batch of MIDI files into data/fragments/fragment_{batch_id}.parquet.
+    on_file_start(i) is called before the i-th file, and on_file_start(None) after the last
+    one (used by the watchdog, so writing the output does not count against a file's timeout).
+
+    If transitions is set, chord n-grams (see core/ngrams.py) also go to
+    data/transitions/transitions_{batch_id}.parquet, as (fname, kind, key, duration).
+
+    If telemetry is set, per-file costs go to data/telemetry/telemetry_{batch_id}.parquet
+    (see file_costs.py): file size, parse and chord-extraction seconds, note and chord counts,
+    and the rows the file contributed to the fragment.
+
+    extract_options go to all_chords_for_score (e.g. {'tolerance': 0.0625, 'unit': 'quarters'},
+    see quantize_report.py).
+
+    Returns a dict of per-batch summaries for the parent to merge:
+    - 'quarantine': list of (fname, error) for files that failed to parse
+    - 'heavy_hitters': HeavyHitters, if heavy_hitters (the summary capacity) is set
+    - 'pcid_histogram': PcidHistogram, if pcid_histogram is set
+    """
     collector = {
         'fname': [],
         'notes': [],
         'duration': [],
     }
+    transition_collector = {
+        'fname': [],
+        'kind': [],
+        'key': [],
+        'duration': [],
+    }
+    telemetry_collector = {
+        'fname': [],
+        'bytes': [],
+        'parse_s': [],
+        'extract_s': [],
+        'n_notes': [],
+        'n_chords': [],
+        'rows': [],
+        'error': [],
+    }
+    summaries = {'quarantine': []}
+    if heavy_hitters:
+        summaries['heavy_hitters'] = HeavyHitters(heavy_hitters)
+    if pcid_histogram:
+        summaries['pcid_histogram'] = PcidHistogram()
 
-    for midi_path in midi_files:
-        result = process_midi_file(midi_path)
+    for i, midi_path in enumerate(midi_files):
+        if on_file_start is not None:
+            on_file_start(i)
+        result = process_midi_file(midi_path, extract_options)
+        if result['error'] is not None:
+            summaries['quarantine'].append((midi_path, result['error']))
         for key in collector:
             collector[key].extend(result[key])
+        if telemetry:
+            telemetry_collector['fname'].append(midi_path)
+            for key, value in result['telemetry'].items():
+                telemetry_collector[key].append(value)
+            # rows after aggregation, if that is what gets written
+            telemetry_collector['rows'].append(
+                len(set(result['notes'])) if aggregate_mode else len(result['notes'])
+            )
+            telemetry_collector['error'].append(result['error'])
+        if heavy_hitters:
+            summaries['heavy_hitters'].update_file(result['notes'], result['duration'])
+        if pcid_histogram:
+            summaries['pcid_histogram'].update_file(result['notes'], result['duration'])
+        if transitions:
+            ngrams = file_transitions(result['notes'], result['duration'], voicing_vocab)
+            for kind, (keys, durations) in ngrams.items():
+                transition_collector['fname'].extend([midi_path] * len(keys))
+                transition_collector['kind'].extend([kind] * len(keys))
+                transition_collector['key'].extend(keys)
+                transition_collector['duration'].extend(durations)
+    if on_file_start is not None:
+        on_file_start(None)
 
     df = pl.DataFrame(collector, schema={
         'fname': pl.Utf8,
@@ -63,47 +178,361 @@ def process_batch(batch_id, midi_files, aggregate_mode=True, output_dir="data/fr
     os.makedirs(output_dir, exist_ok=True)
     df.write_parquet(os.path.join(output_dir, f"fragment_{batch_id}.parquet"))
 
+    if telemetry:
+        os.makedirs(telemetry_dir, exist_ok=True)
+        pl.DataFrame(telemetry_collector, schema={
+            'fname': pl.Utf8,
+            'bytes': pl.Int64,
+            'parse_s': pl.Float64,
+            'extract_s': pl.Float64,
+            'n_notes': pl.Int64,
+            'n_chords': pl.Int64,
+            'rows': pl.Int64,
+            'error': pl.Utf8,
+        }).write_parquet(os.path.join(telemetry_dir, f"telemetry_{batch_id}.parquet"))
+
+    if transitions:
+        df = pl.DataFrame(transition_collector, schema={
+            'fname': pl.Utf8,
+            'kind': pl.Utf8,
+            'key': pl.UInt64,
+            'duration': pl.Float64,
+        })
+        if aggregate_mode:
+            df = df.group_by('fname', 'kind', 'key').agg(
+                pl.col('duration').sum().alias('duration')
+            )
+        os.makedirs(transitions_dir, exist_ok=True)
+        df.write_parquet(os.path.join(transitions_dir, f"transitions_{batch_id}.parquet"))
+
+    return summaries
+
+
+def list_midi_files(midi_root: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(midi_root, "**", "*.mid"), recursive=True))
+
+
+def make_batches(midi_files: list[str], batch_size: int = 1000, batch_bytes: int = None) -> list[list[str]]:
+    """
+    Split files into batches of at most batch_size files.
+    With batch_bytes, a batch is also closed once its files add up to batch_bytes,
+    so a few huge files get batches of their own instead of holding up 999 small ones.
+    """
+    if batch_bytes is None:
+        return [
+            midi_files[i:i + batch_size]
+            for i in range(0, len(midi_files), batch_size)
+        ]
+
+    batches = []
+    batch, size = [], 0
+    for midi_path in midi_files:
+        file_size = os.path.getsize(midi_path)
+        if batch and (len(batch) >= batch_size or size + file_size > batch_bytes):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(midi_path)
+        size += file_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def gil_enabled() -> bool:
+    # False only on free-threaded builds (3.13t) running without the GIL
+    return getattr(sys, '_is_gil_enabled', lambda: True)()
+
+
+def ingest_threaded(
+    midi_files: list[str],
+    n_threads: int,
+    builder: FragmentBuilder,
+    extract_options: dict = None,
+    heavy_hitters: int = None,
+    pcid_histogram: bool = False,
+):
+    """
+    The thread backend of collect_chords_directory_parallel: one pool of threads in this process,
+    each parsing a file and appending its rows to the shared builder (see core/fragment_builder.py).
+    Symusic parses in native code; on a free-threaded build the chord extraction runs in parallel too.
+    Returns (quarantine, heavy hitters, pcid histogram), like the merged summaries of the process pool.
+    """
+    quarantine = []
+    merged = HeavyHitters(heavy_hitters) if heavy_hitters else None
+    histogram = PcidHistogram() if pcid_histogram else None
+    lock = threading.Lock()
+    cancelled = threading.Event()
+
+    def work(midi_path):
+        if cancelled.is_set():
+            return
+        result = process_midi_file(midi_path, extract_options)
+        try:
+            builder.add(midi_path, result)
+        except IngestionCancelled:
+            # the other threads skip their remaining files
+            cancelled.set()
+            raise
+        with lock:
+            if result['error'] is not None:
+                quarantine.append((midi_path, result['error']))
+            if heavy_hitters:
+                merged.update_file(result['notes'], result['duration'])
+            if pcid_histogram:
+                histogram.update_file(result['notes'], result['duration'])
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        for _ in tqdm(executor.map(work, midi_files), total=len(midi_files), desc="Processing files", unit="file"):
+            pass
+    builder.close()
+    return quarantine, merged, histogram
+
+
+def bytes_per_input_byte(midi_files: list[str], sample: int = 16, extract_options: dict = None) -> float:
+    """
+    In-memory size of the chord rows per byte of MIDI, from a sample spread over the (sorted) files.
+    """
+    step = max(1, len(midi_files) // sample)
+    rows, in_bytes = 0, 0
+    for path in midi_files[::step][:sample]:
+        result = process_midi_file(path, extract_options)
+        df = pl.DataFrame({k: result[k] for k in ('fname', 'notes', 'duration')}, schema={
+            'fname': pl.Utf8,
+            'notes': pl.List(pl.Int32),
+            'duration': pl.Float64,
+        })
+        rows += df.estimated_size()
+        in_bytes += os.path.getsize(path)
+    return rows / max(in_bytes, 1)
+
 
 def collect_chords_directory_parallel(
     midi_root: str,
     batch_size: int = 1000,
     n_processes: int = None,
     aggregate_mode: bool = True,
-    output_dir: str = "data/fragments"
+    output_dir: str = "data/fragments",
+    heavy_hitters: int = None,
+    heavy_hitters_k: int = 20,
+    heavy_hitters_path: str = "data/chords/final/heavy_hitters.parquet",
+    midi_files: list[str] = None,
+    transitions: bool = False,
+    voicing_vocab: dict = None,
+    transitions_dir: str = "data/transitions",
+    batch_bytes: int = None,
+    file_timeout: float = None,
+    quarantine_path: str = "data/quarantine.parquet",
+    batch_prefix: str = "",
+    sample_fraction: float = None,
+    sample_strata: str = 'directory',
+    sample_seed: int = 0,
+    sample_design_path: str = "data/sample/design.parquet",
+    telemetry: bool = False,
+    telemetry_dir: str = "data/telemetry",
+    dedup_path: str = None,
+    extract_options: dict = None,
+    pcid_histogram: bool = False,
+    pcid_histogram_path: str = "data/chords/final/pcid_histogram.parquet",
+    memory_budget=None,
+    backend: str = 'process',
+    keep_going=None,
 ):
-    all_midi_files = sorted(glob.glob(os.path.join(midi_root, "**", "*.mid"), recursive=True))
+    """
+    Parse every MIDI file under midi_root into parquet fragments.
+    Pass midi_files to process an explicit list of files instead.
+
+    batch_bytes caps the total file size of a batch (see make_batches); the largest batches
+    are handed out first. With file_timeout (seconds), a watchdog kills any worker stuck on one
+    file for longer and re-runs the rest of its batch (see core/watchdog.py).
+    Files that fail, time out or crash a worker are written to quarantine_path with their error.
+    batch_prefix is prepended to batch ids, so several runs can share one output_dir.
+
+    If transitions is set, workers also write chord n-grams over PCIDs and, given a
+    voicing_vocab (see core/ngrams.load_voicing_vocab), over top voicings; see ngram_transitions.py.
+
+    If heavy_hitters is set, workers also keep a Space-Saving summary of that capacity per PCID,
+    and the merged top heavy_hitters_k voicings are written to heavy_hitters_path
+    as soon as ingestion finishes (see HeavyHitters.to_df for the error bounds).
+
+    If pcid_histogram is set, workers also fill dense 2048-entry per-PCID arrays, and a table in
+    the layout of step5_encipher's most_popular_cls_packed (plus files) is written to
+    pcid_histogram_path (and as .csv) as soon as ingestion finishes; see core/pcid_histogram.py.
+    The default path is not step5's export, so the two never overwrite each other.
+
+    memory_budget (bytes, or a string like "16GiB") replaces batch_size, n_processes and
+    batch_bytes with a plan from core/governor.py, sized from a sample of the actual files.
+
+    extract_options go to all_chords_for_score: onset/offset quantization and a minimum chord
+    duration (see quantize_report.py for their effect on the number of distinct voicings).
+
+    With dedup_path (a mapping from dedup_inputs.build_canonical_map), exact and near duplicate
+    files are skipped; only the canonical file of each group is parsed.
+
+    With telemetry, workers also record per-file costs under telemetry_dir (see file_costs.py).
+
+    backend='thread' runs n_processes threads in this process instead of a process pool
+    (see ingest_threaded; no transitions or file_timeout, a thread cannot be killed);
+    'auto' picks it on free-threaded builds only. ingest_benchmark.py compares the two.
+
+    keep_going() is called before the first batch and after every batch (thread backend: before
+    every fragment is written); once it returns False, no further batch is started or written
+    and IngestionCancelled is raised. sharded_ingest uses it to stop as soon as a lease is lost.
+
+    With sample_fraction, only a reproducible stratified sample of the files is parsed
+    (strata: 'directory' or 'size', see core/sampling.py) and the sampling design is written
+    to sample_design_path; sample_estimates.py turns the fragments into tables with intervals.
+    """
+    if midi_files is None:
+        all_midi_files = list_midi_files(midi_root)
+    else:
+        all_midi_files = sorted(midi_files)
+
+    if sample_fraction is not None:
+        design = stratified_sample(all_midi_files, sample_fraction, sample_strata, midi_root, sample_seed)
+        os.makedirs(os.path.dirname(sample_design_path) or ".", exist_ok=True)
+        design.write_parquet(sample_design_path)
+        print(f"Sampled {design.height} of {len(all_midi_files)} MIDI files "
+              f"from {design['stratum'].n_unique()} strata.")
+        all_midi_files = design['fname'].to_list()
 
     print(f"Found {len(all_midi_files)} MIDI files.")
 
-    # Split into batches
-    batches = [
-        all_midi_files[i:i + batch_size]
-        for i in range(0, len(all_midi_files), batch_size)
-    ]
+    if dedup_path is not None:
+        all_midi_files = canonical_files(all_midi_files, dedup_path)
+        print(f"{len(all_midi_files)} MIDI files left after skipping duplicates.")
+
+    if memory_budget is not None:
+        plan = MemoryGovernor(memory_budget).ingestion_plan(
+            all_midi_files, bytes_per_input_byte(all_midi_files, extract_options=extract_options)
+        )
+        batch_size, n_processes, batch_bytes = plan['batch_size'], plan['n_processes'], plan['batch_bytes']
 
-    if n_processes is None:
-        n_processes = min(mp.cpu_count(), len(batches))
+    if backend == 'auto':
+        backend = 'process' if gil_enabled() else 'thread'
 
-    print(f"Processing {len(batches)} batches using {n_processes} processes...")
+    def check():
+        if keep_going is not None and not keep_going():
+            raise IngestionCancelled("keep_going() returned False")
 
-    with mp.Pool(n_processes) as pool:
+    check()
+
+    if backend == 'thread':
+        if transitions or file_timeout is not None:
+            raise ValueError("transitions and file_timeout need backend='process'")
+        n_threads = n_processes or mp.cpu_count()
+        print(f"Processing {len(all_midi_files)} files using {n_threads} threads "
+              f"({'GIL enabled' if gil_enabled() else 'free-threaded'})...")
+        builder = FragmentBuilder(
+            output_dir,
+            batch_prefix,
+            batch_size,
+            batch_bytes,
+            aggregate_mode,
+            telemetry_dir if telemetry else None,
+            before_write=check,
+        )
+        quarantine, merged, histogram = ingest_threaded(
+            all_midi_files,
+            n_threads,
+            builder,
+            extract_options,
+            heavy_hitters,
+            pcid_histogram,
+        )
+    else:
+        # Split into batches
+        batches = make_batches(all_midi_files, batch_size, batch_bytes)
+
+        if n_processes is None:
+            n_processes = min(mp.cpu_count(), len(batches))
+
+        print(f"Processing {len(batches)} batches using {n_processes} processes...")
+
+        options = {
+            'aggregate_mode': aggregate_mode,
+            'output_dir': output_dir,
+            'heavy_hitters': heavy_hitters,
+            'transitions': transitions,
+            'voicing_vocab': voicing_vocab,
+            'transitions_dir': transitions_dir,
+            'telemetry': telemetry,
+            'telemetry_dir': telemetry_dir,
+            'extract_options': extract_options,
+            'pcid_histogram': pcid_histogram,
+        }
         args = [
-            (i, batch, aggregate_mode, output_dir)
+            (f"{batch_prefix}{i}", batch, options)
             for i, batch in enumerate(batches)
         ]
-        
+        if batch_bytes is not None:
+            # biggest first, so the stragglers are not the last thing to start
+            args.sort(key=lambda a: -sum(os.path.getsize(f) for f in a[1]))
+
+        merged = HeavyHitters(heavy_hitters) if heavy_hitters else None
+        histogram = PcidHistogram() if pcid_histogram else None
+        quarantine = []
+
         # Use tqdm with explicit configuration for better visibility
-        results = []
         with tqdm(total=len(args), desc="Processing batches", unit="batch") as pbar:
-            for result in pool.imap_unordered(_process_batch_wrapper, args):
-                results.append(result)
+
+            def on_result(result):
+                nonlocal merged, histogram
+                # leaving the pool (or watchdog) terminates the workers
+                check()
+                # merge summaries as they arrive, so only one per batch is alive at a time
+                quarantine.extend(result['quarantine'])
+                if heavy_hitters:
+                    merged = merged.merge(result['heavy_hitters'])
+                if pcid_histogram:
+                    histogram = histogram.merge(result['pcid_histogram'])
                 pbar.update(1)
                 pbar.refresh()
 
+            def on_quarantine(fname, error):
+                quarantine.append((fname, error))
+
+            if file_timeout is None:
+                # spawn, not fork: forking after polars has started its thread pool can deadlock
+                # (e.g. incremental_merge reads parquet before ingesting)
+                with mp.get_context("spawn").Pool(n_processes) as pool:
+                    for result in pool.imap_unordered(_process_batch_wrapper, args):
+                        on_result(result)
+            else:
+                run_with_watchdog(
+                    process_batch,
+                    [(i, batch) for i, batch, _ in args],
+                    n_processes,
+                    options,
+                    file_timeout,
+                    on_result,
+                    on_quarantine,
+                )
+
+    if quarantine:
+        os.makedirs(os.path.dirname(quarantine_path) or ".", exist_ok=True)
+        pl.DataFrame(quarantine, schema={'fname': pl.Utf8, 'error': pl.Utf8}, orient='row').write_parquet(
+            quarantine_path
+        )
+        print(f"Quarantined {len(quarantine)} files, see {quarantine_path}")
+
+    if heavy_hitters:
+        top_k = merged.to_df(heavy_hitters_k)
+        os.makedirs(os.path.dirname(heavy_hitters_path), exist_ok=True)
+        top_k.write_parquet(heavy_hitters_path)
+        print(f"Wrote {top_k.height} heavy hitters to {heavy_hitters_path}")
+
+    if pcid_histogram:
+        packed = histogram.to_df()
+        os.makedirs(os.path.dirname(pcid_histogram_path), exist_ok=True)
+        packed.write_parquet(pcid_histogram_path)
+        packed.drop('files').write_csv(os.path.splitext(pcid_histogram_path)[0] + ".csv")
+        print(f"Wrote {packed.height} PCIDs to {pcid_histogram_path}")
+
 
 def _process_batch_wrapper(args):
     """Wrapper function to unpack arguments for process_batch."""
-    return process_batch(*args)
+    batch_id, midi_files, options = args
+    return process_batch(batch_id, midi_files, **options)
 
 
 if __name__ == "__main__":
@@ -114,8 +543,7 @@ if __name__ == "__main__":
 
     collect_chords_directory_parallel(
         midi_root="C:/conjunct/bigdata/aria-midi/aria-midi-v1-ext/data",
-        batch_size=1000,
-        n_processes=4,
+        memory_budget="16GiB",
         aggregate_mode=True,
         output_dir="data/fragments"
     )
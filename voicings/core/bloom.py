@@ -0,0 +1,89 @@
+import math
+
+import numpy as np
+import polars as pl
+
+_WORDS_PER_BLOCK = 8
+"""
+Each block is 8 x 64 = 512 bits, i.e. one cache line.
+All k probes for a key land in the same block, so a lookup touches one cache line.
+"""
+
+_BLOCK_BITS = _WORDS_PER_BLOCK * 64
+
+
+def hash_keys(df: pl.DataFrame, col='notes', seed=0) -> np.ndarray:
+    """
+    Hash a column (e.g. the 'notes' lists) to uint64.
+    The seed must be the same for every pass over the data.
+    """
+    return df.select(pl.col(col).hash(seed=seed)).to_series().to_numpy()
+
+
+class BlockedBloomFilter:
+    """
+    A blocked Bloom filter over uint64 hashes.
+    No false negatives; false positive rate is roughly fp_rate at the given capacity.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float = 0.01):
+        n_bits = max(_BLOCK_BITS, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.n_blocks = -(-n_bits // _BLOCK_BITS)
+        self.k = max(1, round(n_bits / capacity * math.log(2))) if capacity else 1
+        self.words = np.zeros(self.n_blocks * _WORDS_PER_BLOCK, dtype=np.uint64)
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def _probes(self, hashes: np.ndarray):
+        """
+        Yield (word index, bit mask) for each of the k probes.
+        Upper 32 bits pick the block, lower 32 bits drive double hashing within it.
+        """
+        hashes = hashes.astype(np.uint64, copy=False)
+        block = (hashes >> np.uint64(32)) % np.uint64(self.n_blocks)
+        base = block * np.uint64(_WORDS_PER_BLOCK)
+        h1 = hashes & np.uint64(0xFFFF)
+        h2 = ((hashes >> np.uint64(16)) & np.uint64(0xFFFF)) | np.uint64(1)
+        for i in range(self.k):
+            pos = (h1 + np.uint64(i) * h2) % np.uint64(_BLOCK_BITS)
+            yield base + (pos >> np.uint64(6)), np.uint64(1) << (pos & np.uint64(63))
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        found = np.ones(len(hashes), dtype=bool)
+        for idx, mask in self._probes(hashes):
+            found &= (self.words[idx] & mask) != 0
+        return found
+
+    def add(self, hashes: np.ndarray):
+        for idx, mask in self._probes(hashes):
+            np.bitwise_or.at(self.words, idx, mask)
+
+
+class SeenTwiceFilter:
+    """
+    A pair of blocked Bloom filters: `seen` holds every key streamed so far,
+    `twice` holds every key streamed at least twice.
+
+    A key that really occurs twice is always in `twice` (no false negatives).
+    A key that occurs once is in `twice` only with probability ~fp_rate.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float = 0.01):
+        self.seen = BlockedBloomFilter(capacity, fp_rate)
+        self.twice = BlockedBloomFilter(capacity, fp_rate)
+
+    @property
+    def nbytes(self):
+        return self.seen.nbytes + self.twice.nbytes
+
+    def add(self, hashes: np.ndarray):
+        # repeats within the batch, plus anything already seen in earlier batches
+        _, inverse, counts = np.unique(hashes, return_inverse=True, return_counts=True)
+        repeated = (counts[inverse] > 1) | self.seen.contains(hashes)
+        self.twice.add(hashes[repeated])
+        self.seen.add(hashes)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        return self.twice.contains(hashes)
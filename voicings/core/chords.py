@@ -2,18 +2,40 @@ import symusic.types as smt
 
 from voicings.core.decipher import Voicing
 
-def all_chords_for_score(score: smt.Score) -> list[Voicing]:
+def all_chords_for_score(
+        score: smt.Score,
+        tolerance: float = None,
+        min_duration: float = None,
+        unit: str = 'ticks',
+    ) -> list[Voicing]:
     """
     Get all chords (sets of pitches sounding together) for a given score.
     Returns a list of Voicing objects with duration information, sorted by time.
+
+    Performed MIDI staggers onsets by a few ticks, which shows up as many tiny transitional chords.
+    tolerance snaps every onset and offset to a grid of that size (notes that collapse to zero
+    length are dropped), and chords shorter than min_duration are not emitted.
+    Both are in ticks, or in quarter notes with unit='quarters'; durations are always in ticks.
     """
+    if unit == 'quarters':
+        tolerance = tolerance * score.ticks_per_quarter if tolerance else tolerance
+        min_duration = min_duration * score.ticks_per_quarter if min_duration else min_duration
+    elif unit != 'ticks':
+        raise ValueError(f"Unknown unit: {unit}")
+
     # Build a list of (time, pitch, on/off) events
     events = []
 
     for track in score.tracks:
         for note in track.notes:
-            events.append((note.start, note.pitch, 'on'))
-            events.append((note.end, note.pitch, 'off'))
+            start, end = note.start, note.end
+            if tolerance:
+                start = round(start / tolerance) * tolerance
+                end = round(end / tolerance) * tolerance
+                if end <= start:
+                    continue
+            events.append((start, note.pitch, 'on'))
+            events.append((end, note.pitch, 'off'))
     # Sort events by time, with 'off' before 'on' at the same time
     events.sort(key=lambda x: (x[0], 0 if x[2] == 'off' else 1))
 
@@ -28,7 +50,8 @@ def all_chords_for_score(score: smt.Score) -> list[Voicing]:
                 # If we have a current chord, finalize it with duration
                 if current_chord_start is not None:
                     duration = time - current_chord_start
-                    chords.append(Voicing(tuple(sorted(sounding)), current_chord_start, duration))
+                    if not min_duration or duration >= min_duration:
+                        chords.append(Voicing(tuple(sorted(sounding)), current_chord_start, duration))
                 current_chord_start = time
             elif current_chord_start is not None:
                 # Silence period - no chord sounding
@@ -48,7 +71,8 @@ def all_chords_for_score(score: smt.Score) -> list[Voicing]:
     if sounding and current_chord_start is not None:
         # Calculate duration until the last event time
         final_duration = last_time - current_chord_start if last_time else 0
-        chords.append(Voicing(tuple(sorted(sounding)), current_chord_start, final_duration))
+        if not min_duration or final_duration >= min_duration:
+            chords.append(Voicing(tuple(sorted(sounding)), current_chord_start, final_duration))
     
     return chords
 
@@ -1,15 +1,21 @@
-from typing import Callable
-import polars as pl
-from tqdm import tqdm
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Callable
 
 from voicings.core.pl_tqdm import w_pbar
 
+if TYPE_CHECKING:
+    # imported where used, so importing this module stays cheap
+    import polars as pl
+
 def classify_chords(df: pl.DataFrame):
     """
     Adds the "bass" column, which is the lowest note.
     Adds the "rel" column, which is the notes relative to the bass.
     Adds the "cls" column, deduplicates 
     """
+    import polars as pl
+    from tqdm import tqdm
 
     def notes_to_cls(notes):
         bass = min(notes)
@@ -30,11 +36,21 @@ def classify_chords(df: pl.DataFrame):
         )
     return df
 
+def rel_expr(col='notes') -> pl.Expr:
+    """
+    Vectorized version of the "rel" column from classify_chords: notes relative to the bass.
+    """
+    import polars as pl
+
+    return pl.col(col).list.eval(pl.element() - pl.element().min())
+
 def list_eval_ref(
     list_col,
     ref_col,
     op: Callable[[pl.Expr, pl.Expr], pl.Expr],
 ) -> pl.Expr:
+    import polars as pl
+
     return pl.concat_list(pl.struct(list_col, ref_col)).list.eval(
         op(
             pl.element().struct.field(list_col).explode(),
@@ -49,6 +65,8 @@ def untranspose_chords(df: pl.DataFrame):
 
     Adds columns "bass" and "untransposed"
     """
+    import polars as pl
+
     df = df.with_columns(
         pl.col("notes").list.min().alias("bass"),
     )
@@ -1,20 +1,22 @@
+from __future__ import annotations
 
 from dataclasses import dataclass
-
-import polars as pl
-from tqdm import tqdm
+from typing import TYPE_CHECKING
 
 from voicings.core.pl_tqdm import w_pbar
 
+if TYPE_CHECKING:
+    import polars as pl
+
 def int_to_note_name(note: int, octave=True) -> str:
     """Convert an integer note value to a string representation."""
     note_names = [
         "C", "Db", "D", "Eb", "E", "F", "Gb", "G", "Ab", "A", "Bb", "B"
     ]
-    octave = note // 12
     note_name = note_names[note % 12]
-    if octave:
-        return f"{note_name}{octave}"
+    # octave=False used to be overwritten by the octave number, so names always had one
+    if octave and note // 12:
+        return f"{note_name}{note // 12}"
     return note_name
 
 @dataclass(unsafe_hash=True)
@@ -33,6 +35,9 @@ def pretty_print_chords(df: pl.DataFrame, col='notes', octave=True) -> pl.DataFr
     """
     Adds the column "notes_str" to the DataFrame
     """
+    import polars as pl
+    from tqdm import tqdm
+
     def to_better_name(notes):
         return " ".join(int_to_note_name(n, octave=octave) for n in notes)
 
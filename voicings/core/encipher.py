@@ -1,11 +1,15 @@
-import base64
+# Pure Python apart from the pl_* / *_expr helpers, which import polars and tqdm when called,
+# so digest and PCID lookups (see voicings/cli.py) start fast.
 
-from tqdm import tqdm
+from __future__ import annotations
 
-import polars as pl
+from typing import TYPE_CHECKING
 
 from voicings.core.pl_tqdm import w_pbar
 
+if TYPE_CHECKING:
+    import polars as pl
+
 _base64_alphabet = "1234567890ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-._~"
 """
 base64 is modified so that it starts with 1-9, then 0, then A-Z, a-z. 
@@ -37,12 +41,15 @@ def pack_notes(notes):
 
 def unpack_notes(inp: str):
     """
-    
+    Inverse of pack_notes, for notes relative to the lowest one: "37" -> [0, 3, 10]
     """
     cur = 0
     result = [0]
     for c in inp:
-        diff = _base64_alphabet.index(c) - 1
+        if c not in _base64_alphabet:
+            raise ValueError(f"Invalid digest character: {c!r}")
+        # pack_notes stores diff - 1
+        diff = _base64_alphabet.index(c) + 1
         cur += diff
         result.append(cur)
     return result
@@ -52,6 +59,9 @@ def pl_add_digest(df, col='rel', out="digest"):
     Add column 'digest', which is a string representation of the packed pitches in 'rel'.
     Uses slightly modified base64. Balance between readable and compact.
     """
+    import polars as pl
+    from tqdm import tqdm
+
     def to_hex(notes):
         return pack_notes(list(notes))
 
@@ -89,11 +99,37 @@ def unpack_pitch_class(pcid: int) -> list[int]:
             notes.append(i)
     return notes
 
+def pcid_of_notes(notes) -> int:
+    """
+    PCID of a chord straight from its (absolute) notes.
+    Same as pack_pitch_class on the 'cls' column, without building 'rel' and 'cls'.
+    """
+    bass = min(notes)
+    packed = 0
+    for note in notes:
+        pc = (note - bass) % 12
+        if pc:
+            packed |= (1 << (11-pc))
+    return packed
+
+def pcid_expr(col='cls') -> pl.Expr:
+    """
+    Vectorized PCID of a 'cls' (or 'rel') list column; no Python callback per row.
+    """
+    import polars as pl
+
+    return pl.col(col).list.eval(pl.element() % 12).list.unique().list.eval(
+        pl.when(pl.element() > 0).then(pl.lit(2, pl.Int32).pow(11 - pl.element())).otherwise(0)
+    ).list.sum().cast(pl.Int16)
+
 def pl_add_pcid(df, col='cls', out="pcid"):
     """
     Add column 'pcid', which is an integer representation of the packed pitch classes in 'cls'.
     PCID = pitch class ID
     """
+    import polars as pl
+    from tqdm import tqdm
+
     def to_pcid(notes):
         return pack_pitch_class(list(notes))
 
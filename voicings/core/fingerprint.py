@@ -0,0 +1,107 @@
+"""
+Fingerprints of MIDI files.
+
+- content_hash: exact, over the file's bytes, so the same file is recognized under any path or root.
+- MinHash over a score's set of voicings, for near duplicates (re-exports, a changed tempo
+  track or title, a few edited notes). Two files' signatures agree in a fraction of positions
+  that estimates the Jaccard similarity of their voicing sets; LSH banding finds the candidate
+  pairs without comparing every pair.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import polars as pl
+from tqdm import tqdm
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+
+
+def content_hash(path: str) -> str:
+    """
+    Hex BLAKE2b-128 digest of the file's bytes.
+    """
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def hash_files(midi_files: list[str], rebase: tuple[str, str] = None) -> pl.DataFrame:
+    """
+    (fname, digest) for every file, in the given order.
+    rebase=(old_root, new_root) reads files recorded under old_root from new_root instead,
+    e.g. when the full build ran on another machine; fname keeps the recorded path.
+    """
+    collector = {'fname': [], 'digest': []}
+    for fname in tqdm(midi_files, desc="Hashing MIDI files"):
+        path = fname
+        if rebase is not None:
+            path = os.path.join(rebase[1], os.path.relpath(fname, rebase[0]))
+        collector['fname'].append(fname)
+        collector['digest'].append(content_hash(path))
+    return pl.DataFrame(collector, schema={'fname': pl.Utf8, 'digest': pl.Utf8})
+
+
+def _voicing_hash(notes) -> int:
+    # 32-bit hash of a voicing; not hash(), which is not guaranteed stable across versions
+    return int.from_bytes(hashlib.blake2b(bytes(notes), digest_size=4).digest(), 'little')
+
+
+class MinHasher:
+
+    def __init__(self, num_perm: int = 128, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        # a * x + b stays below 2**64 for 32-bit x, so uint64 arithmetic does not wrap
+        self.a = rng.integers(1, 1 << 32, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 32, num_perm, dtype=np.uint64)
+
+    def signature(self, voicings) -> np.ndarray:
+        """
+        MinHash signature (num_perm uint32) of a set of voicings (tuples of MIDI pitches);
+        None for an empty set.
+        """
+        if not voicings:
+            return None
+        x = np.fromiter((_voicing_hash(v) for v in voicings), dtype=np.uint64, count=len(voicings))
+        h = ((np.outer(x, self.a) + self.b) % _MERSENNE_PRIME) & _MAX_HASH
+        return h.min(axis=0).astype(np.uint32)
+
+
+def similarity(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    """
+    Estimated Jaccard similarity of the two voicing sets.
+    """
+    return float(np.mean(sig_a == sig_b))
+
+
+def lsh_candidates(signatures: np.ndarray, bands: int = 16, max_bucket: int = 100) -> set[tuple[int, int]]:
+    """
+    Pairs of rows (i < j) of signatures (n x num_perm) that agree on all rows of at least one band.
+    With r = num_perm / bands rows per band, pairs of similarity s become candidates
+    with probability 1 - (1 - s**r)**bands; about (1 / bands)**(1 / r) is the 50% point.
+    A bucket of more than max_bucket rows (thousands of copies of one piece) would be
+    quadratic, so its members are only paired with its first row; the caller merges
+    transitively, and pairs that do not involve it can still meet in another band.
+    """
+    n, num_perm = signatures.shape
+    r = num_perm // bands
+    pairs = set()
+    for band in range(bands):
+        chunk = np.ascontiguousarray(signatures[:, band * r:(band + 1) * r])
+        keys = chunk.view(np.dtype((np.void, chunk.dtype.itemsize * r))).ravel()
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], n]
+        for start, end in zip(starts, ends):
+            if end - start > max_bucket:
+                members = np.sort(order[start:end])
+                pairs.update((int(members[0]), int(j)) for j in members[1:])
+            elif end - start > 1:
+                members = np.sort(order[start:end])
+                for i in range(len(members)):
+                    for j in range(i + 1, len(members)):
+                        pairs.add((int(members[i]), int(members[j])))
+    return pairs
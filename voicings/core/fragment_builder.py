@@ -0,0 +1,116 @@
+"""
+Shared in-process fragment builder for the thread ingestion backend (see cmaj7_mp).
+
+Worker threads turn each file's chords into a small Arrow-backed polars frame themselves and
+append it here; nothing is pickled or sent between processes. The builder cuts fragments the same
+way make_batches cuts batches (batch_size files, or batch_bytes of MIDI), and writes them as
+fragment_{batch_id}.parquet, so the rest of the pipeline cannot tell which backend produced them.
+Building and writing frames happen outside the lock; only the bookkeeping is serialized.
+"""
+
+import os
+import threading
+
+import polars as pl
+
+FRAGMENT_SCHEMA = {
+    'fname': pl.Utf8,
+    'notes': pl.List(pl.Int32),
+    'duration': pl.Float64,
+}
+
+TELEMETRY_SCHEMA = {
+    'fname': pl.Utf8,
+    'bytes': pl.Int64,
+    'parse_s': pl.Float64,
+    'extract_s': pl.Float64,
+    'n_notes': pl.Int64,
+    'n_chords': pl.Int64,
+    'rows': pl.Int64,
+    'error': pl.Utf8,
+}
+
+
+class FragmentBuilder:
+
+    def __init__(
+            self,
+            output_dir="data/fragments",
+            batch_prefix="",
+            batch_size=1000,
+            batch_bytes=None,
+            aggregate_mode=True,
+            telemetry_dir=None,
+            before_write=None,
+        ):
+        """
+        before_write() is called before each fragment is written, and may raise to prevent it.
+        """
+        self.output_dir = output_dir
+        self.batch_prefix = batch_prefix
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.aggregate_mode = aggregate_mode
+        self.telemetry_dir = telemetry_dir
+        self.before_write = before_write
+        self.n_fragments = 0
+        self.n_rows = 0
+        self._lock = threading.Lock()
+        self._frames, self._telemetry, self._bytes = [], [], 0
+        os.makedirs(output_dir, exist_ok=True)
+        if telemetry_dir is not None:
+            os.makedirs(telemetry_dir, exist_ok=True)
+
+    def add(self, path: str, result: dict):
+        """
+        Append the process_midi_file result for path. Writes a fragment when the current one is full.
+        """
+        n_bytes = result['telemetry']['bytes'] or 0
+        df = pl.DataFrame({k: result[k] for k in FRAGMENT_SCHEMA}, schema=FRAGMENT_SCHEMA)
+        if self.aggregate_mode:
+            # one file per frame, so this is the batch-level group_by of process_batch
+            df = df.group_by('fname', 'notes').agg(pl.col('duration').sum().alias('duration'))
+        telemetry = None
+        if self.telemetry_dir is not None:
+            telemetry = {**result['telemetry'], 'fname': path, 'rows': df.height, 'error': result['error']}
+
+        with self._lock:
+            if self._frames and (
+                len(self._frames) >= self.batch_size
+                or (self.batch_bytes is not None and self._bytes + n_bytes > self.batch_bytes)
+            ):
+                full = self._take()
+            else:
+                full = None
+            self._frames.append(df)
+            if telemetry is not None:
+                self._telemetry.append(telemetry)
+            self._bytes += n_bytes
+        if full is not None:
+            self._write(*full)
+
+    def close(self):
+        with self._lock:
+            full = self._take() if self._frames else None
+        if full is not None:
+            self._write(*full)
+
+    def _take(self):
+        # called with the lock held
+        batch_id = f"{self.batch_prefix}{self.n_fragments}"
+        self.n_fragments += 1
+        full = (batch_id, self._frames, self._telemetry)
+        self._frames, self._telemetry, self._bytes = [], [], 0
+        return full
+
+    def _write(self, batch_id, frames, telemetry):
+        if self.before_write is not None:
+            self.before_write()
+        df = pl.concat(frames, how='vertical')
+        df.write_parquet(os.path.join(self.output_dir, f"fragment_{batch_id}.parquet"))
+        if self.telemetry_dir is not None:
+            pl.DataFrame(telemetry, schema=TELEMETRY_SCHEMA).write_parquet(
+                os.path.join(self.telemetry_dir, f"telemetry_{batch_id}.parquet")
+            )
+        with self._lock:
+            self.n_rows += df.height
@@ -0,0 +1,157 @@
+"""
+Memory-budget governor: turns a RAM budget into chunk sizes, batch sizes, worker counts and
+tournament fan-in, instead of hand-picked constants that either OOM or waste passes.
+
+Sizes are planned from row widths sampled from the actual inputs, times an overhead factor
+(group_by hash tables, concat copies, ...). Around every iteration, mark() and observe()
+measure the peak RSS the iteration itself added and raise the overhead if the plan was
+optimistic, so the next iteration is sized from what really happened. This needs a resettable
+peak (Linux /proc); elsewhere plans are never re-adjusted.
+"""
+
+import multiprocessing as mp
+import os
+import re
+
+import polars as pl
+
+_UNITS = {'': 1, 'k': 10**3, 'm': 10**6, 'g': 10**9, 't': 10**12,
+          'ki': 2**10, 'mi': 2**20, 'gi': 2**30, 'ti': 2**40}
+
+# a spawned ingestion worker, with polars and symusic imported, before it reads any file
+WORKER_BASE_BYTES = 300 * 2**20
+
+
+def parse_budget(budget) -> int:
+    """
+    Bytes from an int or a string like "16GiB", "512 MB", "8g".
+    """
+    if isinstance(budget, (int, float)):
+        return int(budget)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([kmgt]i?)?b?\s*", budget.lower())
+    if match is None:
+        raise ValueError(f"Cannot parse memory budget: {budget!r}")
+    return int(float(match.group(1)) * _UNITS[match.group(2) or ''])
+
+
+def _proc_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss() -> int:
+    """
+    Resident set size of this process, in bytes (None where unavailable).
+    """
+    return _proc_status("VmRSS")
+
+
+def peak_rss() -> int:
+    """
+    Peak resident set size of this process since the last reset_peak_rss(), in bytes
+    (None where unavailable).
+    """
+    return _proc_status("VmHWM")
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak to the current RSS; False where that is not possible.
+    """
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+    except OSError:
+        return False
+    return peak_rss() is not None
+
+
+def sample_row_bytes(source, n: int = 100_000) -> float:
+    """
+    In-memory bytes per row of a parquet path/glob or LazyFrame, from its first n rows.
+    """
+    lf = pl.scan_parquet(source) if isinstance(source, str) else source
+    sample = lf.head(n).collect()
+    return sample.estimated_size() / max(sample.height, 1)
+
+
+def _fmt(n_bytes):
+    return f"{n_bytes / 2**30:.2f} GiB"
+
+
+class MemoryGovernor:
+
+    def __init__(self, budget, overhead: float = 3.0, max_workers: int = None):
+        self.budget = parse_budget(budget)
+        self.overhead = overhead
+        self.max_workers = max_workers or mp.cpu_count()
+        self._baseline = None
+
+    def reserve(self, n_bytes: int, what: str):
+        """
+        Take n_bytes (held for the whole stage, e.g. filters) out of the budget.
+        """
+        if n_bytes >= self.budget:
+            raise ValueError(f"{what} alone need {_fmt(n_bytes)}, more than the {_fmt(self.budget)} budget")
+        self.budget -= n_bytes
+
+    def rows_per_chunk(self, row_bytes: float, minimum: int = 10_000) -> int:
+        """
+        How many rows of width row_bytes fit in the budget, with the current overhead.
+        """
+        rows = int(self.budget / (row_bytes * self.overhead))
+        return max(rows, minimum)
+
+    def fan_in(self, table_bytes: float, maximum: int = 16) -> int:
+        """
+        How many tables of table_bytes each to merge at once (at least 2).
+        """
+        return max(2, min(maximum, int(self.budget / (table_bytes * self.overhead))))
+
+    def ingestion_plan(self, midi_files: list[str], bytes_per_input_byte: float, max_batch_size: int = 10_000) -> dict:
+        """
+        n_processes, batch_size and batch_bytes for collect_chords_directory_parallel.
+        bytes_per_input_byte is the in-memory size of a file's chord rows per byte of MIDI.
+        """
+        total = sum(os.path.getsize(f) for f in midi_files)
+        mean_file = total / max(len(midi_files), 1)
+        per_file = max(mean_file * bytes_per_input_byte * self.overhead, 1)
+
+        # as many workers as fit with room for at least a few files each
+        n_processes = max(1, min(
+            self.max_workers,
+            int(self.budget // (WORKER_BASE_BYTES + 8 * per_file)),
+        ))
+        per_worker = max(self.budget / n_processes - WORKER_BASE_BYTES, per_file)
+        batch_size = max(1, min(max_batch_size, int(per_worker / per_file)))
+        batch_bytes = max(1, int(per_worker / (bytes_per_input_byte * self.overhead)))
+        plan = {'n_processes': n_processes, 'batch_size': batch_size, 'batch_bytes': batch_bytes}
+        print(f"Memory plan for {_fmt(self.budget)}: {plan}")
+        return plan
+
+    def mark(self):
+        """
+        Call at the start of an iteration: what is resident now is not the iteration's doing.
+        """
+        self._baseline = rss() if reset_peak_rss() else None
+
+    def observe(self, data_bytes: float, retained_bytes: float = 0):
+        """
+        Call at the end of an iteration (since mark()) whose chunks held data_bytes of rows
+        (rows * row width) at a time; retained_bytes are its outputs that are still resident,
+        which are not chunk overhead. If the iteration's peak shows the overhead was
+        underestimated, raise it (never lower it: one iteration can be luckier than the next).
+        """
+        peak = peak_rss()
+        if self._baseline is None or peak is None or data_bytes <= 0:
+            return
+        observed = (peak - self._baseline - retained_bytes) / data_bytes
+        if observed > self.overhead:
+            print(f"Peak RSS {_fmt(peak)}: raising overhead from {self.overhead:.2f} to {observed:.2f}")
+            self.overhead = observed
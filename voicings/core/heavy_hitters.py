@@ -0,0 +1,180 @@
+import heapq
+
+import polars as pl
+
+from voicings.core.encipher import pack_notes, pcid_of_notes
+
+
+class SpaceSaving:
+    """
+    Weighted Space-Saving summary (Metwally et al.), mergeable (Agarwal et al.).
+
+    Keeps at most `capacity` keys. For every kept key, `counts[key]` overestimates
+    the true weight by at most `errors[key]`, and `errors[key] <= total / capacity`.
+    Any key with true weight > total / capacity is guaranteed to be kept.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        self._heap = []  # (count, key), lazily invalidated
+
+    def _min(self):
+        while True:
+            count, key = self._heap[0]
+            if self.counts.get(key) == count:
+                return count, key
+            heapq.heappop(self._heap)
+
+    def _push(self, key, count):
+        heapq.heappush(self._heap, (count, key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(c, k) for k, c in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def update(self, key, weight=1):
+        self.total += weight
+        if key in self.counts:
+            self.counts[key] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = weight
+            self.errors[key] = 0
+        else:
+            # evict the smallest key; the newcomer inherits its count as error
+            floor, evicted = self._min()
+            del self.counts[evicted]
+            del self.errors[evicted]
+            self.counts[key] = floor + weight
+            self.errors[key] = floor
+        self._push(key, self.counts[key])
+
+    def floor(self):
+        """
+        Upper bound on the weight of any key not in the summary.
+        """
+        if len(self.counts) < self.capacity:
+            return 0
+        return self._min()[0]
+
+    def merge(self, other: "SpaceSaving") -> "SpaceSaving":
+        """
+        Merge two summaries. Keys missing from one side are charged that side's floor.
+        """
+        merged = SpaceSaving(self.capacity)
+        merged.total = self.total + other.total
+        floor_a, floor_b = self.floor(), other.floor()
+        counts, errors = {}, {}
+        for key in self.counts.keys() | other.counts.keys():
+            counts[key] = self.counts.get(key, floor_a) + other.counts.get(key, floor_b)
+            errors[key] = self.errors.get(key, floor_a) + other.errors.get(key, floor_b)
+        for key in heapq.nlargest(self.capacity, counts, key=counts.get):
+            merged.counts[key] = counts[key]
+            merged.errors[key] = errors[key]
+        merged._heap = [(c, k) for k, c in merged.counts.items()]
+        heapq.heapify(merged._heap)
+        return merged
+
+    def top(self, k=None):
+        """
+        List of (key, count, error), heaviest first.
+        """
+        keys = sorted(self.counts, key=self.counts.get, reverse=True)[:k]
+        return [(key, self.counts[key], self.errors[key]) for key in keys]
+
+
+class HeavyHitters:
+    """
+    Per-PCID heavy-hitter voicings ('rel'), by duration and by file count.
+    Maintained inside ingestion workers and merged in the parent.
+
+    Like group_by_rel, only chords with >= 3 unique pitch classes are counted, and
+    'frequency' counts distinct (file, notes) pairs, i.e. transpositions count separately.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self.by_duration = {}
+        self.by_frequency = {}
+
+    def _summary(self, summaries, pcid):
+        if pcid not in summaries:
+            summaries[pcid] = SpaceSaving(self.capacity)
+        return summaries[pcid]
+
+    def update_file(self, notes_list, durations):
+        """
+        Add one file's chords (absolute notes and durations, as produced by process_midi_file).
+        """
+        per_rel = {}
+        for notes, duration in zip(notes_list, durations):
+            if notes is None:
+                continue
+            bass = min(notes)
+            rel = tuple(note - bass for note in notes)
+            if rel not in per_rel:
+                per_rel[rel] = [0, set()]
+            per_rel[rel][0] += duration
+            per_rel[rel][1].add(tuple(notes))
+
+        for rel, (duration, transpositions) in per_rel.items():
+            pcid = pcid_of_notes(rel)
+            if pcid.bit_count() < 2:
+                continue
+            self._summary(self.by_duration, pcid).update(rel, duration)
+            self._summary(self.by_frequency, pcid).update(rel, len(transpositions))
+
+    def merge(self, other: "HeavyHitters") -> "HeavyHitters":
+        merged = HeavyHitters(self.capacity)
+        for attr in ('by_duration', 'by_frequency'):
+            mine, theirs = getattr(self, attr), getattr(other, attr)
+            out = getattr(merged, attr)
+            for pcid in mine.keys() | theirs.keys():
+                if pcid in mine and pcid in theirs:
+                    out[pcid] = mine[pcid].merge(theirs[pcid])
+                else:
+                    out[pcid] = mine.get(pcid) or theirs[pcid]
+        return merged
+
+    def to_df(self, k: int = 20) -> pl.DataFrame:
+        """
+        Top-k voicings per PCID for each metric.
+
+        'estimate' overestimates the true total by at most 'error', so the true total lies in
+        ['estimate' - 'error', 'estimate']. 'max_error' = total / capacity bounds the error
+        of every voicing of that PCID, including ones that did not make the list.
+        """
+        collector = {
+            'metric': [],
+            'pcid': [],
+            'rank': [],
+            'rel': [],
+            'digest': [],
+            'estimate': [],
+            'error': [],
+            'max_error': [],
+        }
+        for metric, summaries in (('duration', self.by_duration), ('frequency', self.by_frequency)):
+            for pcid, summary in summaries.items():
+                max_error = summary.total / summary.capacity
+                for rank, (rel, count, error) in enumerate(summary.top(k)):
+                    collector['metric'].append(metric)
+                    collector['pcid'].append(pcid)
+                    collector['rank'].append(rank)
+                    collector['rel'].append(list(rel))
+                    collector['digest'].append(pack_notes(list(rel)))
+                    collector['estimate'].append(float(count))
+                    collector['error'].append(float(error))
+                    collector['max_error'].append(max_error)
+
+        return pl.DataFrame(collector, schema={
+            'metric': pl.Utf8,
+            'pcid': pl.Int16,
+            'rank': pl.Int32,
+            'rel': pl.List(pl.Int64),
+            'digest': pl.Utf8,
+            'estimate': pl.Float64,
+            'error': pl.Float64,
+            'max_error': pl.Float64,
+        }).sort('metric', 'pcid', 'rank')
@@ -0,0 +1,138 @@
+"""
+Global voicing dictionary: every distinct 'notes' list gets a dense UInt32 id, forever.
+
+Stored as append-only segments under data/chords/voicing_dict/segment_{n}.parquet,
+each with columns (voicing_id, lo, hi, notes). A chord is a set of MIDI pitches 0-127,
+so (lo, hi) is its exact 128-bit pitch mask; lookups join on those two integers
+instead of hashing the lists. Lookups go through the segments one at a time, so memory
+holds the keys being looked up and one segment, not every mask.
+
+There must be only one writer (assign) at a time.
+"""
+
+import os
+
+import polars as pl
+
+
+def _mask_expr(col, lo) -> pl.Expr:
+    return pl.col(col).list.eval(
+        pl.when((pl.element() >= lo) & (pl.element() < lo + 64))
+        .then(pl.lit(2, pl.UInt64).pow((pl.element() - lo).clip(0, 63)))
+        .otherwise(pl.lit(0, pl.UInt64))
+    ).list.sum()
+
+
+_SEGMENT_SCHEMA = {'voicing_id': pl.UInt32, 'lo': pl.UInt64, 'hi': pl.UInt64, 'notes': pl.List(pl.Int32)}
+
+
+def pitch_mask_exprs(col='notes') -> list[pl.Expr]:
+    """
+    The 128-bit pitch mask of a 'notes' column, as two UInt64 columns 'lo' (pitches 0-63) and 'hi' (64-127).
+    """
+    return [_mask_expr(col, 0).alias('lo'), _mask_expr(col, 64).alias('hi')]
+
+
+class VoicingDictionary:
+
+    def __init__(self, path="data/chords/voicing_dict", segment_rows: int = 1_000_000):
+        """
+        New voicings are buffered and written as a segment once segment_rows of them
+        have accumulated (and by flush()), so segments stay few and large.
+        """
+        self.path = path
+        self.segment_rows = segment_rows
+        os.makedirs(path, exist_ok=True)
+        self._size = None
+        self._pending = pl.DataFrame(schema=_SEGMENT_SCHEMA)
+
+    def _segments(self):
+        return sorted(
+            (f for f in os.listdir(self.path) if f.startswith("segment_") and f.endswith(".parquet")),
+            key=lambda f: int(f[len("segment_"):-len(".parquet")]),
+        )
+
+    def _mask_segments(self):
+        """
+        (voicing_id, lo, hi) of one segment at a time, then of the unwritten voicings;
+        the whole dictionary is never in memory at once.
+        """
+        for f in self._segments():
+            yield pl.read_parquet(os.path.join(self.path, f), columns=['voicing_id', 'lo', 'hi'])
+        yield self._pending.drop('notes')
+
+    def _match(self, keys: pl.DataFrame) -> pl.DataFrame:
+        """
+        (lo, hi, voicing_id) for the keys (unique lo, hi) that are in the dictionary.
+        """
+        found = []
+        for segment in self._mask_segments():
+            if keys.is_empty():
+                break
+            hits = keys.join(segment, on=['lo', 'hi'], how='inner')
+            found.append(hits)
+            keys = keys.join(hits, on=['lo', 'hi'], how='anti')
+        if not found:
+            return pl.DataFrame(schema={'lo': pl.UInt64, 'hi': pl.UInt64, 'voicing_id': pl.UInt32})
+        return pl.concat(found, how='vertical')
+
+    def __len__(self):
+        if self._size is None:
+            self._size = sum(
+                pl.scan_parquet(os.path.join(self.path, f)).select(pl.len()).collect().item()
+                for f in self._segments()
+            ) + self._pending.height
+        return self._size
+
+    def lookup(self, df: pl.DataFrame, col='notes', out='voicing_id') -> pl.DataFrame:
+        """
+        Add column out with the id of each row's voicing (null if not in the dictionary).
+        """
+        df = df.with_columns(*pitch_mask_exprs(col))
+        ids = self._match(df.select('lo', 'hi').unique())
+        return df.join(ids, on=['lo', 'hi'], how='left').drop('lo', 'hi').rename({'voicing_id': out})
+
+    def assign(self, df: pl.DataFrame, col='notes', out='voicing_id') -> pl.DataFrame:
+        """
+        Like lookup, but voicings not seen before are given the next free ids
+        and added to the dictionary (written out by flush, or once a segment is full).
+        """
+        df = df.with_columns(*pitch_mask_exprs(col))
+        keys = df.filter(pl.col(col).is_not_null()).select(col, 'lo', 'hi').unique(
+            subset=['lo', 'hi'], maintain_order=True
+        )
+        ids = self._match(keys.select('lo', 'hi'))
+        new = keys.join(ids, on=['lo', 'hi'], how='anti')
+
+        if new.height:
+            new = new.with_row_index('voicing_id', offset=len(self)).with_columns(
+                pl.col('voicing_id').cast(pl.UInt32)
+            ).select('voicing_id', 'lo', 'hi', pl.col(col).cast(pl.List(pl.Int32)).alias('notes'))
+            self._pending = pl.concat([self._pending, new], how='vertical')
+            self._size += new.height
+            ids = pl.concat([ids, new.select('lo', 'hi', 'voicing_id')], how='vertical')
+            if self._pending.height >= self.segment_rows:
+                self.flush()
+
+        return df.join(ids, on=['lo', 'hi'], how='left').drop('lo', 'hi').rename({'voicing_id': out})
+
+    def flush(self):
+        """
+        Write the buffered new voicings as one segment. Call once the last assign is done.
+        """
+        if self._pending.height:
+            self._pending.write_parquet(os.path.join(self.path, f"segment_{len(self._segments())}.parquet"))
+            self._pending = self._pending.clear()
+
+    def decode(self, df: pl.DataFrame, col='voicing_id', out='notes') -> pl.DataFrame:
+        """
+        Add column out with the notes of each id; only the needed ids are read from disk.
+        """
+        ids = df.select(pl.col(col).unique().alias('voicing_id'))
+        notes = self._pending.select('voicing_id', 'notes').join(ids, on='voicing_id', how='semi')
+        segments = self._segments()
+        if segments:
+            notes = pl.concat([pl.scan_parquet(
+                [os.path.join(self.path, f) for f in segments]
+            ).select('voicing_id', 'notes').join(ids.lazy(), on='voicing_id', how='semi').collect(), notes])
+        return df.join(notes.rename({'voicing_id': col, 'notes': out}), on=col, how='left')
@@ -0,0 +1,90 @@
+"""
+Transition (n-gram) keys.
+
+A chord is first mapped to a small integer id: its PCID (base 2048), or its index in a
+vocabulary of top voicings (base len(vocab) + 1, the last id meaning "any other voicing").
+An n-gram of ids is then packed into one UInt64: key = ((a * base) + b) * base + c.
+"""
+import numpy as np
+import polars as pl
+
+from voicings.core.encipher import pcid_of_notes
+
+PCID_BASE = 2048
+
+
+def encode_ngram(ids, base: int) -> int:
+    key = 0
+    for i in ids:
+        key = key * base + i
+    return key
+
+
+def decode_ngrams(keys: np.ndarray, base: int, order: int) -> list[np.ndarray]:
+    """
+    Vectorized inverse of encode_ngram: one array per position, first chord first.
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    out = []
+    for _ in range(order):
+        out.append((keys % np.uint64(base)).astype(np.int64))
+        keys = keys // np.uint64(base)
+    return out[::-1]
+
+
+def load_voicing_vocab(path="data/chords/final/most_popular_rel.parquet", top_n=10_000) -> dict:
+    """
+    Map the top_n most frequent voicings ('rel' tuples) to ids 0..top_n-1.
+    """
+    df = pl.read_parquet(path, columns=['rel', 'frequency']).sort('frequency', descending=True).head(top_n)
+    return {tuple(rel): i for i, rel in enumerate(df['rel'].to_list())}
+
+
+def _collapse(ids, durations):
+    """
+    Merge runs of the same id (e.g. the same PCID in a different voicing) into one chord.
+    """
+    out_ids, out_durations = [], []
+    for i, duration in zip(ids, durations):
+        if out_ids and out_ids[-1] == i:
+            out_durations[-1] += duration
+        else:
+            out_ids.append(i)
+            out_durations.append(duration)
+    return out_ids, out_durations
+
+
+def file_transitions(notes_list, durations, vocab: dict = None, orders=(2, 3)) -> dict:
+    """
+    N-gram keys of one file's time-ordered chords.
+    Each n-gram is weighted by the duration of the chord it arrives at.
+
+    Returns {kind: (keys, durations)}, with kinds like 'pcid2', 'pcid3', 'voicing2', 'voicing3'.
+    """
+    chords = [(n, d) for n, d in zip(notes_list, durations) if n is not None]
+    sequences = {
+        'pcid': (PCID_BASE, [pcid_of_notes(n) for n, _ in chords]),
+    }
+    if vocab is not None:
+        other = len(vocab)
+        sequences['voicing'] = (other + 1, [vocab.get(tuple(x - min(n) for x in n), other) for n, _ in chords])
+
+    result = {}
+    for name, (base, ids) in sequences.items():
+        ids, durs = _collapse(ids, [d for _, d in chords])
+        for order in orders:
+            keys = [encode_ngram(ids[i:i + order], base) for i in range(len(ids) - order + 1)]
+            result[f"{name}{order}"] = (keys, durs[order - 1:])
+    return result
+
+
+def to_csr(df: pl.DataFrame, base: int, weight='duration'):
+    """
+    Aggregated bigrams (columns 'key' and weight) to a CSR matrix, as (indptr, indices, data).
+    Row = previous chord, column = next chord.
+    """
+    df = df.sort('key')
+    src, dst = decode_ngrams(df['key'].to_numpy(), base, 2)
+    indptr = np.zeros(base + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=base), out=indptr[1:])
+    return indptr, dst.astype(np.int32), df[weight].to_numpy()
@@ -0,0 +1,90 @@
+"""
+Dense PCID histogram: the most_popular_cls table without the voicing-level pipeline.
+
+A PCID has 11 bits, so every statistic is a fixed 2048-entry array; workers fill their own
+and the parent sums them. The result is exact, not a sketch.
+"""
+
+import numpy as np
+import polars as pl
+
+from voicings.core.encipher import pack_pitch_class
+
+N_PCIDS = 2048
+
+
+def _pcid_table() -> np.ndarray:
+    # 12-bit pitch-class set (bit pc set, relative to the bass) -> PCID
+    table = np.zeros(4096, dtype=np.int16)
+    for pcset in range(4096):
+        table[pcset] = pack_pitch_class([pc for pc in range(12) if pcset >> pc & 1])
+    return table
+
+
+_PCID_OF_PCSET = _pcid_table()
+
+
+def pcids_of_chords(notes_list) -> np.ndarray:
+    """
+    PCID of every chord, vectorized: each note sets bit (note - bass) % 12 of its chord's
+    pitch-class mask, and the mask is looked up in a 4096-entry table.
+    """
+    lengths = np.fromiter((len(notes) for notes in notes_list), dtype=np.int64, count=len(notes_list))
+    if not len(lengths):
+        return np.zeros(0, dtype=np.int16)
+    pitches = np.fromiter((n for notes in notes_list for n in notes), dtype=np.int64, count=lengths.sum())
+    starts = np.r_[0, np.cumsum(lengths)[:-1]]
+    bass = np.minimum.reduceat(pitches, starts)
+    bits = np.left_shift(1, (pitches - np.repeat(bass, lengths)) % 12)
+    return _PCID_OF_PCSET[np.bitwise_or.reduceat(bits, starts)]
+
+
+class PcidHistogram:
+    """
+    Per-PCID totals, with the semantics of group_by_cls on the full pipeline:
+    - duration: total chord duration
+    - frequency: distinct (file, notes) pairs
+    - files: files in which the PCID occurs at all
+    """
+
+    def __init__(self):
+        self.duration = np.zeros(N_PCIDS, dtype=np.float64)
+        self.frequency = np.zeros(N_PCIDS, dtype=np.int64)
+        self.files = np.zeros(N_PCIDS, dtype=np.int64)
+
+    def update_file(self, notes_list, durations):
+        """
+        Add one file's chords (absolute notes and durations, as produced by process_midi_file).
+        """
+        if not notes_list:
+            return
+        pcids = pcids_of_chords(notes_list)
+        self.duration += np.bincount(pcids, weights=durations, minlength=N_PCIDS)
+        distinct = dict(zip(map(tuple, notes_list), pcids.tolist()))
+        self.frequency += np.bincount(list(distinct.values()), minlength=N_PCIDS)
+        self.files[np.unique(pcids)] += 1
+
+    def merge(self, other: "PcidHistogram") -> "PcidHistogram":
+        merged = PcidHistogram()
+        for attr in ('duration', 'frequency', 'files'):
+            setattr(merged, attr, getattr(self, attr) + getattr(other, attr))
+        return merged
+
+    def to_df(self) -> pl.DataFrame:
+        """
+        The most_popular_cls_packed table (frequency, duration, pcid), plus files.
+        Like group_by_cls, only PCIDs with >= 3 pitch classes (>= 2 bits) are kept.
+        """
+        pcid = np.arange(N_PCIDS)
+        keep = (self.frequency > 0) & (np.bitwise_count(pcid) >= 2)
+        return pl.DataFrame({
+            'frequency': self.frequency[keep],
+            'duration': self.duration[keep],
+            'pcid': pcid[keep],
+            'files': self.files[keep],
+        }).with_columns(
+            pl.col('frequency').cast(pl.Int32),
+            pl.col('duration').cast(pl.Float32),
+            pl.col('pcid').cast(pl.Int16),
+            pl.col('files').cast(pl.Int32),
+        ).sort('frequency', descending=True)
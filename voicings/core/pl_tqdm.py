@@ -1,7 +1,6 @@
 # https://stackoverflow.com/a/75922391/29032885
 
-import polars as pl
-from tqdm import tqdm
+# no imports: the pure-Python helpers in core import this, and must not pull in polars or tqdm
 
 def w_pbar(pbar, func):
     def foo(*args, **kwargs):
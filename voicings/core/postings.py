@@ -0,0 +1,129 @@
+"""
+Posting lists: sorted file ids, delta-encoded, then varint (LEB128) encoded.
+Encoding and decoding are vectorized, so a posting list of a million ids decodes in milliseconds.
+"""
+import os
+
+import numpy as np
+
+
+def encode_postings(groups: np.ndarray, ids: np.ndarray, n_groups: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Encode many posting lists at once.
+    groups: posting list number of each id, non-decreasing. ids: sorted and unique within a group.
+    Returns (blob, offsets) such that list g is blob[offsets[g]:offsets[g + 1]].
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    ids = np.asarray(ids, dtype=np.uint64)
+
+    deltas = ids.copy()
+    if len(ids):
+        same = groups[1:] == groups[:-1]
+        deltas[1:][same] = ids[1:][same] - ids[:-1][same]
+
+    n_bytes = np.ones(len(deltas), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        n_bytes += deltas >= (1 << shift)
+
+    starts = np.cumsum(n_bytes) - n_bytes
+    blob = np.zeros(int(n_bytes.sum()), dtype=np.uint8)
+    for j in range(5):
+        mask = n_bytes > j
+        byte = (deltas[mask] >> np.uint64(7 * j)) & np.uint64(0x7F)
+        byte |= np.where(n_bytes[mask] > j + 1, 0x80, 0).astype(np.uint64)
+        blob[starts[mask] + j] = byte
+
+    offsets = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(groups, weights=n_bytes, minlength=n_groups), out=offsets[1:])
+    return blob, offsets
+
+
+def decode_postings(blob) -> np.ndarray:
+    """
+    Decode one posting list back to sorted file ids.
+    """
+    b = np.asarray(blob, dtype=np.uint8)
+    if len(b) == 0:
+        return np.zeros(0, dtype=np.uint32)
+    ends = (b & 0x80) == 0
+    starts = np.flatnonzero(np.concatenate([[True], ends[:-1]]))
+    value_of_byte = np.cumsum(np.concatenate([[0], ends[:-1]]))
+    pos = np.arange(len(b)) - starts[value_of_byte]
+    parts = (b & 0x7F).astype(np.uint64) << (np.uint64(7) * pos.astype(np.uint64))
+    deltas = np.add.reduceat(parts, starts)
+    return np.cumsum(deltas).astype(np.uint32)
+
+
+def _memmap(path):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+class PostingIndex:
+    """
+    Read-only inverted index (see voicings/inverted_index.py for the layout).
+    Everything is memory-mapped, so opening is cheap and queries touch only the lists they need.
+    """
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        self.pcid_offsets = np.load(os.path.join(index_dir, "pcid_offsets.npy"), mmap_mode='r')
+        self.pcid_blob = _memmap(os.path.join(index_dir, "pcid_postings.bin"))
+        self.digest_offsets = np.load(os.path.join(index_dir, "digest_offsets.npy"), mmap_mode='r')
+        self.digest_blob = _memmap(os.path.join(index_dir, "digest_postings.bin"))
+        self.key_offsets = np.load(os.path.join(index_dir, "digest_key_offsets.npy"), mmap_mode='r')
+        self.keys = _memmap(os.path.join(index_dir, "digest_keys.bin"))
+        self._fnames = None
+
+    def _key(self, i) -> bytes:
+        return self.keys[self.key_offsets[i]:self.key_offsets[i + 1]].tobytes()
+
+    def _find_digest(self, digest: str):
+        # binary search over the sorted digests
+        target = digest.encode()
+        lo, hi = 0, len(self.key_offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.key_offsets) - 1 and self._key(lo) == target:
+            return lo
+        return None
+
+    def pcid(self, pcid: int) -> np.ndarray:
+        """
+        Ids of the files containing any voicing with this PCID.
+        """
+        return decode_postings(self.pcid_blob[self.pcid_offsets[pcid]:self.pcid_offsets[pcid + 1]])
+
+    def digest(self, digest: str) -> np.ndarray:
+        """
+        Ids of the files containing this voicing (digest of 'rel', as in the export), in any transposition.
+        """
+        i = self._find_digest(digest)
+        if i is None:
+            return np.zeros(0, dtype=np.uint32)
+        return decode_postings(self.digest_blob[self.digest_offsets[i]:self.digest_offsets[i + 1]])
+
+    def query(self, digests=(), pcids=()) -> np.ndarray:
+        """
+        Ids of the files containing all of the given voicings and PCIDs.
+        """
+        lists = [self.digest(d) for d in digests] + [self.pcid(p) for p in pcids]
+        if not lists:
+            return np.zeros(0, dtype=np.uint32)
+        # intersect smallest first
+        lists.sort(key=len)
+        result = lists[0]
+        for other in lists[1:]:
+            result = np.intersect1d(result, other, assume_unique=True)
+        return result
+
+    def fnames(self, file_ids) -> list[str]:
+        if self._fnames is None:
+            with open(os.path.join(self.index_dir, "files.txt"), encoding='utf-8') as f:
+                self._fnames = f.read().split("\n")
+        return [self._fnames[i] for i in file_ids]
@@ -0,0 +1,163 @@
+"""
+Stratified sampling of MIDI files, and estimates of population totals with confidence intervals.
+
+A sample of a few percent of the corpus is enough to rank the common chord classes; the
+intervals say how far each row can be trusted. Strata are directories (collections tend to
+differ in style) or file-size bins (size tracks the number of chords).
+"""
+
+import os
+import random
+
+import numpy as np
+import polars as pl
+
+
+def stratify(midi_files: list[str], strata='directory', midi_root: str = None, n_size_bins: int = 10) -> dict:
+    """
+    Assign every file to a stratum: its directory (relative to midi_root), or its file-size decile.
+    """
+    if strata == 'directory':
+        return {f: os.path.dirname(os.path.relpath(f, midi_root) if midi_root else f) for f in midi_files}
+    if strata == 'size':
+        by_size = sorted(midi_files, key=os.path.getsize)
+        return {f: f"size_{i * n_size_bins // len(by_size)}" for i, f in enumerate(by_size)}
+    raise ValueError(f"Unknown strata: {strata}")
+
+
+def stratified_sample(
+        midi_files: list[str],
+        fraction: float,
+        strata='directory',
+        midi_root: str = None,
+        seed: int = 0,
+    ) -> pl.DataFrame:
+    """
+    Reproducible stratified sample without replacement.
+
+    Every stratum keeps round(fraction * N_h) files, but at least 2 (so its variance can be
+    estimated) and at most N_h. The same files, seed and fraction always give the same sample.
+
+    Returns the design: one row per sampled file with its stratum, N_h and n_h.
+    """
+    groups = {}
+    for f, stratum in stratify(midi_files, strata, midi_root).items():
+        groups.setdefault(stratum, []).append(f)
+
+    collector = {'fname': [], 'stratum': [], 'N_h': [], 'n_h': []}
+    for stratum, files in sorted(groups.items()):
+        files = sorted(files)
+        n_h = min(len(files), max(2, round(fraction * len(files))))
+        rng = random.Random(f"{seed}:{stratum}")
+        for f in sorted(rng.sample(files, n_h)):
+            collector['fname'].append(f)
+            collector['stratum'].append(stratum)
+            collector['N_h'].append(len(files))
+            collector['n_h'].append(n_h)
+
+    return pl.DataFrame(collector, schema={
+        'fname': pl.Utf8,
+        'stratum': pl.Utf8,
+        'N_h': pl.Int64,
+        'n_h': pl.Int64,
+    })
+
+
+def stratified_totals(per_file: pl.DataFrame, design: pl.DataFrame, key, values: list[str], z: float = 1.96) -> pl.DataFrame:
+    """
+    Estimate population totals per key from a stratified sample.
+
+    per_file: one row per (fname, key) with the file's value(s); files where the key does not occur
+    count as 0 and need no row. Sampled files that failed to parse stay in the design and also
+    count as 0, which is what they contribute to the full pipeline. For each value column v this returns v (the estimate of the
+    total), v_se, and a normal-approximation interval [v_lo, v_hi] at the given z.
+
+    T = sum_h N_h / n_h * sum_i y_i
+    Var(T) = sum_h N_h^2 (1 - n_h / N_h) s_h^2 / n_h, with s_h^2 the sample variance over all n_h files.
+    """
+    keys = [key] if isinstance(key, str) else list(key)
+    strata = design.select('stratum', 'N_h', 'n_h').unique()
+
+    per_stratum = per_file.join(design.select('fname', 'stratum'), on='fname').group_by(*keys, 'stratum').agg(
+        *[pl.col(v).sum().alias(f"{v}_sum") for v in values],
+        *[(pl.col(v) ** 2).sum().alias(f"{v}_sumsq") for v in values],
+    ).join(strata, on='stratum')
+
+    terms = []
+    for v in values:
+        s, ss = pl.col(f"{v}_sum"), pl.col(f"{v}_sumsq")
+        n, N = pl.col('n_h').cast(pl.Float64), pl.col('N_h').cast(pl.Float64)
+        s2 = ((ss - s ** 2 / n) / (n - 1)).clip(lower_bound=0)
+        terms += [
+            (N / n * s).alias(v),
+            # a fully enumerated stratum (including every single-file one) has no sampling variance
+            pl.when(n < N).then(N ** 2 * (1 - n / N) * s2 / n).otherwise(0.0).alias(f"{v}_var"),
+        ]
+
+    out = per_stratum.select(*keys, *terms).group_by(keys).agg(pl.all().sum())
+    return out.with_columns(
+        *[pl.col(f"{v}_var").sqrt().alias(f"{v}_se") for v in values]
+    ).with_columns(
+        *[(pl.col(v) - z * pl.col(f"{v}_se")).clip(lower_bound=0).alias(f"{v}_lo") for v in values],
+        *[(pl.col(v) + z * pl.col(f"{v}_se")).alias(f"{v}_hi") for v in values],
+    ).drop([f"{v}_var" for v in values])
+
+
+def bootstrap_totals(
+        per_file: pl.DataFrame,
+        design: pl.DataFrame,
+        key,
+        values: list[str],
+        n_boot: int = 200,
+        level: float = 0.95,
+        seed: int = 0,
+    ) -> pl.DataFrame:
+    """
+    Like stratified_totals, but with percentile intervals from a stratified bootstrap:
+    every replicate redraws n_h files with replacement inside each stratum.
+
+    The replicates are materialized as (fname, key) x n_boot rows, so keep this to samples,
+    or to the top of a table.
+    """
+    keys = [key] if isinstance(key, str) else list(key)
+    rng = np.random.default_rng(seed)
+
+    weights = []
+    for part in design.partition_by('stratum', maintain_order=True):
+        n_h, N_h = part['n_h'][0], part['N_h'][0]
+        # multiplicity of every file in every replicate
+        counts = rng.multinomial(n_h, np.full(part.height, 1 / part.height), size=n_boot)
+        weights.append(pl.DataFrame({
+            'fname': np.tile(part['fname'].to_numpy(), n_boot),
+            'replicate': np.repeat(np.arange(n_boot, dtype=np.int32), part.height),
+            'weight': (counts * (N_h / n_h)).ravel(),
+        }).filter(pl.col('weight') > 0))
+    weights = pl.concat(weights)
+
+    alpha = (1 - level) / 2
+    replicates = per_file.join(weights, on='fname').group_by(*keys, 'replicate').agg(
+        *[(pl.col(v) * pl.col('weight')).sum() for v in values]
+    )
+    # a key missing from a replicate has a total of 0 there, not a missing value
+    missing = replicates.group_by(keys).agg(
+        (n_boot - pl.len()).alias('_missing')
+    )
+    intervals = replicates.group_by(keys).agg(
+        *[pl.col(v).alias(f"{v}_boot") for v in values]
+    ).join(missing, on=keys).with_columns(
+        *[
+            pl.concat_list(
+                pl.col(f"{v}_boot"),
+                pl.lit(0.0).repeat_by(pl.col('_missing')),
+            ).alias(f"{v}_boot")
+            for v in values
+        ]
+    ).select(
+        *keys,
+        *[pl.col(f"{v}_boot").list.std().alias(f"{v}_se") for v in values],
+        *[pl.col(f"{v}_boot").list.eval(pl.element().quantile(alpha)).list.first().alias(f"{v}_lo") for v in values],
+        *[pl.col(f"{v}_boot").list.eval(pl.element().quantile(1 - alpha)).list.first().alias(f"{v}_hi") for v in values],
+    )
+
+    point = stratified_totals(per_file, design, keys, values).select(*keys, *values)
+    return point.join(intervals, on=keys, how='left')
@@ -0,0 +1,125 @@
+"""
+A small process pool with per-file timeouts.
+
+multiprocessing.Pool cannot cancel a task: one pathological MIDI file stalls its whole batch,
+and a worker that dies in native code loses the batch. Here every worker reports which file
+it is on and since when; the parent kills a worker that overruns file_timeout (or that died),
+quarantines that one file, and re-queues the rest of the batch on a fresh worker.
+"""
+
+import multiprocessing as mp
+import queue
+import time
+from collections import deque
+
+
+def _worker(target, slot, tasks, results, started, current, options):
+    def on_file_start(i):
+        # None: past the last file; writing the batch's output is not on any file's clock
+        if i is None:
+            started[slot] = 0.0
+            return
+        current[slot] = i
+        started[slot] = time.time()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batch_id, files = task
+        result = target(batch_id, files, on_file_start=on_file_start, **options)
+        started[slot] = 0.0
+        results.put((slot, batch_id, result))
+
+
+def run_with_watchdog(target, batches, n_processes, options, file_timeout, on_result, on_quarantine, poll=1.0, max_retries=3):
+    """
+    Run target(batch_id, files, on_file_start=..., **options) for every (batch_id, files) in batches.
+    Batches are handed out one at a time to whichever worker is idle, in the given order.
+    on_result(result) is called in the parent for every finished batch,
+    on_quarantine(fname, error) for every file that timed out or killed its worker.
+    target must call on_file_start(i) before its i-th file and on_file_start(None) after the last one.
+    A batch whose worker dies before starting on it is retried at most max_retries times,
+    after which all of its files are quarantined.
+    """
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    started = ctx.Array('d', n_processes, lock=False)
+    current = ctx.Array('i', n_processes, lock=False)
+    workers = [None] * n_processes
+    task_queues = [None] * n_processes
+
+    def start(slot):
+        task_queues[slot] = ctx.Queue()
+        started[slot] = 0.0
+        workers[slot] = ctx.Process(
+            target=_worker,
+            args=(target, slot, task_queues[slot], results, started, current, options),
+            daemon=True,
+        )
+        workers[slot].start()
+
+    for slot in range(n_processes):
+        start(slot)
+
+    pending = deque(batches)
+    in_flight = {}
+    retries = {}
+    try:
+        while pending or in_flight:
+            for slot in range(n_processes):
+                if slot not in in_flight and pending:
+                    in_flight[slot] = pending.popleft()
+                    task_queues[slot].put(in_flight[slot])
+
+            try:
+                slot, batch_id, result = results.get(timeout=poll)
+                del in_flight[slot]
+                on_result(result)
+            except queue.Empty:
+                pass
+
+            now = time.time()
+            for slot, (batch_id, files) in list(in_flight.items()):
+                timed_out = started[slot] and now - started[slot] > file_timeout
+                died = not workers[slot].is_alive()
+                if not (timed_out or died):
+                    continue
+                if died and not started[slot]:
+                    # died before it picked the batch up (or after its last file); retry it, but not forever
+                    retries[batch_id] = retries.get(batch_id, 0) + 1
+                    if retries[batch_id] > max_retries:
+                        for f in files:
+                            on_quarantine(f, f"worker died {max_retries + 1} times on this batch "
+                                             f"(exit code {workers[slot].exitcode})")
+                        bad = files
+                    else:
+                        bad = []
+                else:
+                    bad = [files[current[slot]]]
+                    if timed_out:
+                        on_quarantine(bad[0], f"timeout: still running after {file_timeout}s")
+                    else:
+                        on_quarantine(bad[0], f"worker died (exit code {workers[slot].exitcode})")
+                workers[slot].kill()
+                workers[slot].join()
+                del in_flight[slot]
+                # the batch's fragment was never written, so redo it without the bad file
+                remaining = [f for f in files if f not in bad]
+                if remaining:
+                    pending.appendleft((batch_id, remaining))
+                start(slot)
+    except BaseException:
+        # e.g. on_result cancelled the run: stop now, do not let running batches finish
+        for worker in workers:
+            if worker is not None and worker.is_alive():
+                worker.kill()
+        raise
+    finally:
+        for slot in range(n_processes):
+            if workers[slot].is_alive():
+                task_queues[slot].put(None)
+        for slot in range(n_processes):
+            workers[slot].join(timeout=5)
+            if workers[slot].is_alive():
+                workers[slot].kill()
@@ -28,13 +28,27 @@
 # - progressive filtering
 # - multi-pass distinct elimination
 
+# Two-pass alternative (see sketch_singleton_elimination):
+# 1. Stream every key through a pair of Bloom filters, flagging keys seen at least twice
+# 2. Stream again: flagged keys go to the groupby, the rest are singletons and go straight to disk
+# Memory is fixed by the filter size and chunk size, there is no shuffle, and nothing is left unresolved.
+# False positives only send a few singletons through the groupby, which is still exact.
 
+
+import glob
 import os
+import shutil
+
 import polars as pl
 from tqdm import tqdm
 
 from voicings.chord_tournament import aggregate_df, prune_df
+from voicings.core.bloom import SeenTwiceFilter, hash_keys
+from voicings.core.governor import MemoryGovernor, sample_row_bytes
 
+# two-pass Bloom filter mode; False for the original heuristic.
+# pass the same to step2_finalize.collect_final_aggregation(sketch=...).
+USE_SKETCH = True
 
 
 def cyclic_agg_1(df: pl.DataFrame, k: int = 30_000_000, prune_max_freq: int = 1):
@@ -97,12 +111,12 @@ def cyclic_agg_3(chunks: list[pl.DataFrame], known_duplicates: pl.DataFrame) ->
         pl.concat(uni_collector, how='vertical')
     )
 
-def cyclic_agg_4(df: pl.DataFrame):
+def cyclic_agg_4(df: pl.DataFrame, key='notes'):
     """
     4. Group by non-unique values and aggregate
     """
     # Group by non-unique values and aggregate
-    return df.group_by('notes').agg(
+    return df.group_by(key).agg(
         pl.col('duration').sum().alias('duration'),
         pl.col('frequency').sum().alias('frequency')
     ).sort('duration', descending=True)
@@ -112,19 +126,31 @@ def cyclic_agg_tournament(
         k: int = 30_000_000, 
         prune_max_freq: int = 1, 
         max_iterations=5, 
-        prefix='data/chords/cyclic'
+        prefix='data/chords/cyclic',
+        memory_budget=None,
     ):
     """
     Perform a cyclic aggregation tournament on the dataframe.
+    With memory_budget, k is chosen from the row width of df and re-chosen after every
+    iteration from the peak RSS that iteration added (see core/governor.py).
     """
     print("Starting cyclic aggregation tournament")
     os.makedirs(prefix, exist_ok=True)
     ctr = 0
 
+    governor = None
+    if memory_budget is not None:
+        governor = MemoryGovernor(memory_budget)
+        row_bytes = sample_row_bytes(df.lazy())
+        k = governor.rows_per_chunk(row_bytes)
+        print(f"Chunks of {k} rows")
+
     remainder_out = df
     pre_height = remainder_out.height
     while pre_height > 0 and ctr < max_iterations:
         print("Iteration", ctr)
+        if governor is not None:
+            governor.mark()
         chunks = cyclic_agg_1(remainder_out, k, prune_max_freq)
         print("Chunking done.")
         non_unique = cyclic_agg_2(chunks)
@@ -134,11 +160,21 @@ def cyclic_agg_tournament(
         step_agg = cyclic_agg_4(step_out)
         step_agg.write_parquet(f"{prefix}/agg_step_{ctr}.parquet")
         print("Written to file.")
+        one_batch = pre_height <= k
+
+        if governor is not None:
+            # before the shuffle, whose copy of the remainder is not the chunks' doing
+            governor.observe(
+                min(pre_height, k) * row_bytes,
+                retained_bytes=sum(df.estimated_size() for df in (step_out, step_agg, remainder_out)),
+            )
+            k = governor.rows_per_chunk(row_bytes)
+        del chunks, step_out
 
         # Now we need to shuffle remainder_out to avoid bias in the next iteration
         remainder_out = remainder_out.sample(fraction=1, shuffle=True, seed=42)
         print("Done shuffling.")
-        if pre_height <= k:
+        if one_batch:
             # that means that we are done
             print("We processed the entire data in one batch; stopping.")
             break
@@ -150,24 +186,110 @@ def cyclic_agg_tournament(
 
     remainder_out.write_parquet(f"{prefix}/remainder_{ctr}.parquet")
 
+
+def sketch_singleton_elimination(
+        path: str,
+        k: int = 30_000_000,
+        fp_rate: float = 0.01,
+        prefix='data/chords/sketch',
+        seed=0,
+        key='notes',
+        n_partitions: int = 64,
+        memory_budget=None,
+    ):
+    """
+    Two-pass singleton elimination over a parquet file of (notes, duration, frequency).
+
+    Writes {prefix}/agg_step_0.parquet (keys seen at least twice, aggregated)
+    and {prefix}/remainder/part_*.parquet (keys seen exactly once, untouched).
+
+    Flagged rows are spilled to n_partitions partitions by key hash and each partition is
+    aggregated on its own, so memory is bounded by k rows, the filters, and the largest
+    partition (about 1/n_partitions of the repeated keys), not by all repeated keys at once.
+    With memory_budget, k is whatever fits next to the filters (see core/governor.py).
+    """
+    print("Starting sketch singleton elimination")
+    remainder_dir = f"{prefix}/remainder"
+    spill_dir = f"{prefix}/flagged"
+    agg_dir = f"{prefix}/agg"
+    # an earlier run may have written more remainder parts than this one will
+    for d in (remainder_dir, spill_dir, agg_dir):
+        shutil.rmtree(d, ignore_errors=True)
+        os.makedirs(d)
+
+    lf = pl.scan_parquet(path)
+    height = lf.select(pl.len()).collect().item()
+    print(f"Starting with {height} rows")
+
+    sketch = SeenTwiceFilter(height, fp_rate)
+    print(f"Filters use {sketch.nbytes / 2**20:.1f} MiB")
+    if memory_budget is not None:
+        governor = MemoryGovernor(memory_budget)
+        governor.reserve(sketch.nbytes, "The filters")
+        k = governor.rows_per_chunk(sample_row_bytes(path))
+        print(f"Chunks of {k} rows")
+    offsets = range(0, height, k)
+
+    for offset in tqdm(offsets, desc="Pass 1: sketching keys"):
+        chunk = lf.slice(offset, k).select(key).collect()
+        sketch.add(hash_keys(chunk, col=key, seed=seed))
+
+    n_singletons = 0
+    for i, offset in enumerate(tqdm(offsets, desc="Pass 2: routing keys")):
+        chunk = lf.slice(offset, k).collect()
+        hashes = hash_keys(chunk, col=key, seed=seed)
+        flagged = pl.Series(sketch.contains(hashes))
+        # the high bits pick the partition, so every copy of a key lands in the same one
+        buckets = pl.Series('_bucket', (hashes >> 40) % n_partitions)
+        for part in chunk.with_columns(buckets).filter(flagged).partition_by('_bucket', include_key=False, as_dict=True).items():
+            (bucket,), rows = part
+            rows.write_parquet(f"{spill_dir}/part_{bucket}_{i}.parquet")
+        singletons = chunk.filter(~flagged)
+        singletons.write_parquet(f"{remainder_dir}/part_{i}.parquet")
+        n_singletons += singletons.height
+    del sketch
+    print(f"Routed {n_singletons} singletons straight to disk.")
+
+    for bucket in tqdm(range(n_partitions), desc="Aggregating repeated keys"):
+        files = glob.glob(f"{spill_dir}/part_{bucket}_*.parquet")
+        if files:
+            cyclic_agg_4(pl.read_parquet(files), key).write_parquet(f"{agg_dir}/part_{bucket}.parquet")
+    pl.scan_parquet(f"{agg_dir}/*.parquet").sink_parquet(f"{prefix}/agg_step_0.parquet")
+    shutil.rmtree(spill_dir)
+    shutil.rmtree(agg_dir)
+
+    n_repeated = pl.scan_parquet(f"{prefix}/agg_step_0.parquet").select(pl.len()).collect().item()
+    print(f"Aggregated {n_repeated} repeated keys. Written to file.")
+
+
 if __name__ == "__main__":
 
     # Phase 1: filter
     # sanity check: make sure that infrequent_refuse all has frequency 1
-    df = pl.read_parquet(f"data/chords/infrequent_refuse.parquet")
-
-    exceptions = df.filter(
+    exceptions = pl.scan_parquet(f"data/chords/infrequent_refuse.parquet").filter(
         pl.col('frequency') > 1
-    )
+    ).collect()
     if exceptions.height > 0:
         print("There are exceptions in infrequent_refuse:")
         print(exceptions)
         exit(0)
 
+    if USE_SKETCH:
+        # produces data/chords/sketch/agg_step_0.parquet
+        # produces data/chords/sketch/remainder/part_*.parquet
+        sketch_singleton_elimination(
+            "data/chords/infrequent_refuse.parquet",
+            memory_budget="32GiB",
+            prefix='data/chords/sketch'
+        )
+        exit(0)
+
+    df = pl.read_parquet(f"data/chords/infrequent_refuse.parquet")
+
     # # begin cyclic aggregation tournament
     cyclic_agg_tournament(
         df,
-        k=30_000_000,
+        memory_budget="32GiB",
         prune_max_freq=1,
         max_iterations=5,
         prefix='data/chords/cyclic-1'
@@ -179,9 +301,8 @@ if __name__ == "__main__":
 
     cyclic_agg_tournament(
         df,
-        k=130_000_000,
+        memory_budget="32GiB",
         prune_max_freq=1,
         max_iterations=5,
         prefix='data/chords/cyclic-2'
     )
-
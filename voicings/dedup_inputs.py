@@ -0,0 +1,165 @@
+# Pre-ingestion deduplication of MIDI inputs.
+
+# Scraped corpora contain the same piece many times: byte-identical copies, and near copies
+# (re-exported, retitled, a few notes edited). Every copy adds its voicings to 'frequency'
+# (fname.n_unique()), so the duplicates are both wasted CPU and wrong counts.
+
+# 1. exact:  files with the same content hash are one file
+# 2. near:   MinHash of each remaining file's voicing set, LSH banding for candidate pairs,
+#            and pairs whose estimated Jaccard similarity is >= threshold are merged (transitively)
+# The result is data/dedup/canonical.parquet: (fname, digest, canonical, reason, similarity)
+# where canonical is the one file of its group that gets ingested, and reason is
+# 'exact' / 'near' for the duplicates (null for canonical files).
+#   collect_chords_directory_parallel(..., dedup_path="data/dedup/canonical.parquet")
+# then skips every file whose canonical is another file.
+
+# The near-duplicate pass parses every file once; it only runs on files that survive step 1.
+
+import multiprocessing as mp
+import os
+
+import numpy as np
+import polars as pl
+from symusic import Score
+from tqdm import tqdm
+
+from voicings.core.chords import all_chords_for_score
+from voicings.core.fingerprint import MinHasher, hash_files, lsh_candidates, similarity
+
+
+def _voicing_set(path):
+    try:
+        with open(path, 'rb') as f:
+            score = Score.from_midi(f.read())
+    except Exception:
+        return None
+    return {c.notes for c in all_chords_for_score(score) if len(c.notes) >= 3}
+
+
+def _fingerprint(args):
+    path, num_perm, seed = args
+    voicings = _voicing_set(path)
+    if not voicings:
+        return path, 0, None
+    return path, len(voicings), MinHasher(num_perm, seed).signature(voicings)
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def near_duplicate_groups(
+        midi_files: list[str],
+        threshold: float = 0.9,
+        num_perm: int = 128,
+        bands: int = 16,
+        n_processes: int = None,
+        seed: int = 1,
+    ) -> pl.DataFrame:
+    """
+    (fname, n_voicings, group, similarity) for the given files: files in the same group have voicing
+    sets with estimated Jaccard similarity >= threshold, directly or through other files.
+    similarity is to the best match that put the file in its group (null for singletons).
+    """
+    n_processes = n_processes or mp.cpu_count()
+    with mp.get_context("spawn").Pool(n_processes) as pool:
+        results = list(tqdm(
+            pool.imap(_fingerprint, [(f, num_perm, seed) for f in midi_files], chunksize=16),
+            total=len(midi_files),
+            desc="Fingerprinting voicing sets",
+        ))
+
+    fnames = [path for path, _, sig in results if sig is not None]
+    sizes = {path: n for path, n, _ in results}
+    parent = list(range(len(midi_files)))
+    best = {}
+    if fnames:
+        signatures = np.stack([sig for _, _, sig in results if sig is not None])
+        index = {f: i for i, f in enumerate(midi_files)}
+        for i, j in tqdm(lsh_candidates(signatures, bands), desc="Checking candidate pairs"):
+            s = similarity(signatures[i], signatures[j])
+            if s < threshold:
+                continue
+            a, b = index[fnames[i]], index[fnames[j]]
+            parent[_find(parent, a)] = _find(parent, b)
+            best[a] = max(best.get(a, 0.0), s)
+            best[b] = max(best.get(b, 0.0), s)
+
+    return pl.DataFrame({
+        'fname': midi_files,
+        'n_voicings': [sizes[f] for f in midi_files],
+        'group': [_find(parent, i) for i in range(len(midi_files))],
+        'similarity': [best.get(i) for i in range(len(midi_files))],
+    }, schema={'fname': pl.Utf8, 'n_voicings': pl.Int64, 'group': pl.Int64, 'similarity': pl.Float64})
+
+
+def build_canonical_map(
+        midi_files: list[str],
+        output_path="data/dedup/canonical.parquet",
+        near: bool = True,
+        **kwargs
+    ) -> pl.DataFrame:
+    """
+    Decide the canonical file of every input and write the mapping. kwargs go to near_duplicate_groups.
+    The canonical file of a group is the one with the most voicings (then the first path),
+    so a truncated copy never stands in for the full piece.
+    """
+    hashed = hash_files(sorted(midi_files))
+    exact = hashed.with_columns(
+        pl.col('fname').min().over('digest').alias('exact_canonical')
+    )
+    unique_files = exact.filter(pl.col('fname') == pl.col('exact_canonical'))['fname'].to_list()
+    print(f"{hashed.height} files, {len(unique_files)} distinct by content.")
+
+    if near:
+        groups = near_duplicate_groups(unique_files, **kwargs).with_columns(
+            pl.col('fname').sort_by([pl.col('n_voicings'), pl.col('fname')], descending=[True, False])
+            .first().over('group').alias('near_canonical')
+        )
+    else:
+        groups = pl.DataFrame({'fname': unique_files}, schema={'fname': pl.Utf8}).with_columns(
+            pl.col('fname').alias('near_canonical'), pl.lit(None, pl.Float64).alias('similarity')
+        )
+
+    df = exact.join(
+        groups.select(pl.col('fname').alias('exact_canonical'), 'near_canonical', 'similarity'),
+        on='exact_canonical',
+        how='left',
+    ).select(
+        'fname',
+        'digest',
+        pl.col('near_canonical').alias('canonical'),
+        pl.when(pl.col('fname') != pl.col('exact_canonical')).then(pl.lit('exact'))
+        .when(pl.col('fname') != pl.col('near_canonical')).then(pl.lit('near'))
+        .alias('reason'),
+        pl.when(pl.col('fname') != pl.col('exact_canonical')).then(pl.lit(1.0))
+        .otherwise(pl.col('similarity')).alias('similarity'),
+    )
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    df.write_parquet(output_path)
+    counts = df.group_by('reason').len()
+    print(f"Wrote {output_path}:")
+    print(counts)
+    return df
+
+
+def canonical_files(midi_files: list[str], dedup_path="data/dedup/canonical.parquet") -> list[str]:
+    """
+    Drop files whose canonical file is another file. Files missing from the mapping are kept.
+    """
+    mapping = pl.read_parquet(dedup_path).select('fname', 'canonical')
+    duplicates = set(mapping.filter(pl.col('fname') != pl.col('canonical'))['fname'])
+    return [f for f in midi_files if f not in duplicates]
+
+
+if __name__ == "__main__":
+    from voicings.cmaj7_mp import list_midi_files
+
+    build_canonical_map(
+        list_midi_files("C:/conjunct/bigdata/aria-midi/aria-midi-v1-ext/data"),
+        threshold=0.9,
+    )
@@ -0,0 +1,71 @@
+# Which MIDI files dominate ingestion time and fragment size?
+
+# Ingest with telemetry on:
+#   collect_chords_directory_parallel(..., telemetry=True)
+# and every batch writes data/telemetry/telemetry_{batch_id}.parquet with one row per file:
+# (fname, bytes, parse_s, extract_s, n_notes, n_chords, rows, error).
+# This prints the distribution of each cost and the worst files, and writes them to
+# data/telemetry/report/ for a closer look (e.g. to build an exclusion list, or to pick batch_bytes).
+
+import os
+
+import polars as pl
+
+COSTS = ['bytes', 'parse_s', 'extract_s', 'total_s', 'n_notes', 'n_chords', 'rows', 'chords_per_note']
+
+
+def load_telemetry(telemetry_dir="data/telemetry") -> pl.DataFrame:
+    return pl.read_parquet(os.path.join(telemetry_dir, "telemetry_*.parquet")).with_columns(
+        (pl.col('parse_s') + pl.col('extract_s')).alias('total_s'),
+        (pl.col('n_chords') / pl.col('n_notes')).alias('chords_per_note'),
+    )
+
+
+def cost_distribution(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Quantiles of every cost, plus the share of the total taken by the top 1% of files.
+    """
+    rows = []
+    for cost in COSTS:
+        col = df[cost].drop_nulls().drop_nans() if df[cost].dtype.is_float() else df[cost].drop_nulls()
+        if col.len() == 0:
+            continue
+        top = col.sort(descending=True).head(max(1, col.len() // 100))
+        rows.append({
+            'cost': cost,
+            'mean': col.mean(),
+            'p50': col.quantile(0.5),
+            'p90': col.quantile(0.9),
+            'p99': col.quantile(0.99),
+            'max': col.max(),
+            'total': col.sum(),
+            'top1pct_share': top.sum() / col.sum() if col.sum() else None,
+        })
+    return pl.DataFrame(rows)
+
+
+def top_offenders(df: pl.DataFrame, by='total_s', n=20) -> pl.DataFrame:
+    return df.sort(by, descending=True, nulls_last=True).head(n).select(
+        'fname', by, *[c for c in COSTS if c != by]
+    )
+
+
+def cost_report(telemetry_dir="data/telemetry", n=20, output_dir="data/telemetry/report"):
+    df = load_telemetry(telemetry_dir)
+    print(f"{df.height} files, {df['error'].is_not_null().sum()} with errors")
+
+    distribution = cost_distribution(df)
+    print("Cost distribution:")
+    print(distribution)
+
+    os.makedirs(output_dir, exist_ok=True)
+    distribution.write_parquet(os.path.join(output_dir, "distribution.parquet"))
+    for by in ('total_s', 'rows', 'n_notes'):
+        worst = top_offenders(df, by, n)
+        print(f"Top {n} files by {by}:")
+        print(worst)
+        worst.write_parquet(os.path.join(output_dir, f"top_{by}.parquet"))
+
+
+if __name__ == "__main__":
+    cost_report()
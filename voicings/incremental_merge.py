@@ -0,0 +1,351 @@
+# Incremental delta merge of new corpora into the final tables.
+
+# Rebuilding final_aggregation.parquet from every fragment is hours of work.
+# Instead, keep the final tables hash-partitioned on their key, and version them:
+
+# data/chords/final/versions/
+#     CURRENT                          <- number of the live version
+#     v0/manifest.json                 <- partition -> file, for every table
+#     v0/final_aggregation/part_*.parquet
+#     v1/manifest.json                 <- mostly points back into v0/
+#     v1/final_aggregation/part_17.parquet   <- only partitions the delta touched
+#     ...
+
+# All three tables are sums over voicings, so a delta can be added key by key:
+# - final_aggregation: keyed on notes
+# - most_popular_rel: keyed on rel
+# - most_popular_cls: keyed on cls (small, kept in one partition)
+# 'frequency' is a file count, so this assumes the new files are not already ingested;
+# ingested files are tracked per version by content hash (so a collection seen under another
+# path or root is still recognized) and skipped by ingest_delta.
+
+# Rolling back is just pointing CURRENT at an older version.
+
+import argparse
+import json
+import os
+import re
+import time
+
+import polars as pl
+from tqdm import tqdm
+
+from voicings.chord_tournament import aggregate_df
+from voicings.cmaj7_mp import collect_chords_directory_parallel, list_midi_files
+from voicings.core.classify import classify_chords
+from voicings.core.decipher import pretty_print_chords
+from voicings.core.fingerprint import hash_files
+
+VERSIONS_DIR = "data/chords/final/versions"
+
+TABLES = {
+    # name: (key, columns carried along with the sums, partitioned)
+    'final_aggregation': ('notes', [], True),
+    'most_popular_rel': ('rel', ['cls'], True),
+    'most_popular_cls': ('cls', [], False),
+}
+
+
+def stable_bucket(col: str, n_partitions: int) -> pl.Expr:
+    """
+    Partition number of a list-of-ints key.
+    Unlike Expr.hash, this does not change between polars versions, so it is safe to persist.
+    """
+    return (
+        pl.col(col).list.eval(
+            (pl.element().cast(pl.UInt64) + 1)
+            * (pl.int_range(pl.len(), dtype=pl.UInt64) * 0x9E3779B1 + 0x85EBCA6B)
+        ).list.sum() % n_partitions
+    ).cast(pl.UInt32).alias('_bucket')
+
+
+def _merge_sums(df: pl.DataFrame, key: str, carry: list[str]) -> pl.DataFrame:
+    return df.group_by(key).agg(
+        pl.col('frequency').sum().alias('frequency'),
+        pl.col('duration').sum().alias('duration'),
+        *[pl.col(c).first().alias(c) for c in carry],
+    )
+
+
+def _write_json(path, obj):
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp, path)
+
+
+def current_version(root=VERSIONS_DIR) -> int:
+    with open(os.path.join(root, "CURRENT")) as f:
+        return int(f.read().strip())
+
+
+def next_version(root=VERSIONS_DIR) -> int:
+    """
+    One past the newest version with a manifest. After a rollback, CURRENT + 1 may already exist
+    (the version rolled back from), and must not be overwritten. A directory without a manifest
+    is a merge that crashed before going live, and is reused.
+    """
+    versions = [
+        int(m.group(1)) for d in os.listdir(root)
+        if (m := re.fullmatch(r"v(\d+)", d)) and os.path.exists(os.path.join(root, d, "manifest.json"))
+    ]
+    return max(versions, default=-1) + 1
+
+
+def load_manifest(version: int = None, root=VERSIONS_DIR) -> dict:
+    if version is None:
+        version = current_version(root)
+    with open(os.path.join(root, f"v{version}", "manifest.json")) as f:
+        return json.load(f)
+
+
+def scan_table(name: str, version: int = None, root=VERSIONS_DIR) -> pl.LazyFrame:
+    """
+    Lazily read one table of a version (default: the live one).
+    """
+    manifest = load_manifest(version, root)
+    parts = manifest['tables'][name]['partitions']
+    return pl.scan_parquet([os.path.join(root, p) for p in parts.values()])
+
+
+def rollback(version: int, root=VERSIONS_DIR):
+    """
+    Make a version live (e.g. roll back to an older one). Other versions stay on disk.
+    """
+    load_manifest(version, root)  # make sure it exists
+    with open(os.path.join(root, "CURRENT.tmp"), 'w') as f:
+        f.write(str(version))
+    os.replace(os.path.join(root, "CURRENT.tmp"), os.path.join(root, "CURRENT"))
+    print(f"Version {version} is now live")
+
+
+def _write_partitions(df: pl.DataFrame, name: str, vdir: str, n_partitions: int, partitioned: bool) -> dict:
+    """
+    Write df as partition files under vdir/name; returns {partition: path relative to the versions root}.
+    """
+    key = TABLES[name][0]
+    os.makedirs(os.path.join(vdir, name), exist_ok=True)
+    version_name = os.path.basename(vdir)
+    if not partitioned:
+        df.write_parquet(os.path.join(vdir, name, "part_0.parquet"))
+        return {"0": f"{version_name}/{name}/part_0.parquet"}
+
+    written = {}
+    for part in df.with_columns(stable_bucket(key, n_partitions)).partition_by('_bucket'):
+        bucket = part['_bucket'][0]
+        part.drop('_bucket').write_parquet(os.path.join(vdir, name, f"part_{bucket}.parquet"))
+        written[str(bucket)] = f"{version_name}/{name}/part_{bucket}.parquet"
+    return written
+
+
+def init_versions(
+        ingested_files: list[str],
+        root=VERSIONS_DIR,
+        n_partitions: int = 256,
+        final_dir="data/chords/final",
+        rebase: tuple[str, str] = None,
+    ):
+    """
+    Bootstrap version 0 from the existing full-rebuild outputs in final_dir
+    (final_aggregation.parquet, most_popular_rel.parquet, most_popular_cls.parquet).
+    ingested_files are the MIDI files those outputs were built from; they are hashed here,
+    so they must be readable (see hash_files for rebase).
+    """
+    hashed = hash_files(sorted(ingested_files), rebase)
+    vdir = os.path.join(root, "v0")
+    os.makedirs(vdir, exist_ok=True)
+
+    tables = {}
+    for name, (key, carry, partitioned) in TABLES.items():
+        print(f"Partitioning {name}...")
+        df = pl.read_parquet(os.path.join(final_dir, f"{name}.parquet"))
+        df = df.select(key, 'frequency', 'duration', *carry)
+        tables[name] = {
+            'key': key,
+            'partitions': _write_partitions(df, name, vdir, n_partitions, partitioned),
+        }
+
+    hashed.write_parquet(os.path.join(vdir, "ingested.parquet"))
+    _write_json(os.path.join(vdir, "manifest.json"), {
+        'version': 0,
+        'parent': None,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'note': "initial full build",
+        'n_partitions': n_partitions,
+        'tables': tables,
+        'ingested': ["v0/ingested.parquet"],
+    })
+    rollback(0, root)
+
+
+def ingested_digests(version: int = None, root=VERSIONS_DIR) -> set[str]:
+    """
+    Content hashes of every file ingested up to a version.
+    """
+    manifest = load_manifest(version, root)
+    paths = [os.path.join(root, p) for p in manifest['ingested']]
+    return set(pl.scan_parquet(paths).select('digest').collect()['digest'])
+
+
+def ingest_delta(midi_root: str, delta_dir: str, root=VERSIONS_DIR, **kwargs) -> pl.DataFrame:
+    """
+    Parse only the MIDI files under midi_root whose content no version has ingested yet
+    (and only one copy of files that are identical to each other).
+    Fragments go to delta_dir. Returns (fname, digest) of the new files.
+
+    The plan is kept in delta_dir/plan.parquet. If ingestion already finished for the
+    live version (a crash before merge_delta), the fragments are reused; a half-done
+    ingestion is started over.
+    """
+    plan_path = os.path.join(delta_dir, "plan.parquet")
+    done_path = os.path.join(delta_dir, "plan.done")
+    parent = current_version(root)
+
+    if os.path.exists(plan_path):
+        with open(os.path.join(delta_dir, "plan.json")) as f:
+            planned_on = json.load(f)['parent']
+        if planned_on != parent:
+            raise ValueError(f"{delta_dir} was already merged; use a fresh directory per delta")
+        if os.path.exists(done_path):
+            new_files = pl.read_parquet(plan_path)
+            print(f"Reusing the {new_files.height} already ingested files in {delta_dir}.")
+            return new_files
+    elif os.path.isdir(delta_dir) and any(f.endswith(".parquet") for f in os.listdir(delta_dir)):
+        raise ValueError(f"{delta_dir} already has fragments; use a fresh directory per delta")
+
+    for f in os.listdir(delta_dir) if os.path.isdir(delta_dir) else []:
+        if f.startswith("fragment_"):
+            os.remove(os.path.join(delta_dir, f))
+
+    seen = ingested_digests(root=root)
+    new_files = hash_files(list_midi_files(midi_root)).filter(
+        ~pl.col('digest').is_in(list(seen))
+    ).unique(subset='digest', keep='first', maintain_order=True)
+    print(f"{new_files.height} new MIDI files ({len(seen)} already ingested).")
+
+    os.makedirs(delta_dir, exist_ok=True)
+    new_files.write_parquet(plan_path)
+    _write_json(os.path.join(delta_dir, "plan.json"), {'parent': parent})
+    if new_files.height:
+        collect_chords_directory_parallel(
+            midi_root, midi_files=new_files['fname'].to_list(), output_dir=delta_dir, **kwargs
+        )
+    with open(done_path, 'w') as f:
+        f.write(time.strftime("%Y-%m-%dT%H:%M:%S"))
+    return new_files
+
+
+def aggregate_delta(delta_dir: str) -> pl.DataFrame:
+    """
+    Aggregate delta fragments to (notes, duration, frequency).
+    Each file sits in exactly one fragment, so per-fragment file counts add up.
+    """
+    files = [os.path.join(delta_dir, f) for f in os.listdir(delta_dir) if f.startswith("fragment_")]
+    aggs = [aggregate_df(pl.read_parquet(path)) for path in tqdm(files, desc="Aggregating delta")]
+    return aggregate_df(pl.concat(aggs, how="vertical")).filter(pl.col('notes').is_not_null())
+
+
+def _derived_deltas(delta: pl.DataFrame) -> dict[str, pl.DataFrame]:
+    """
+    The delta of every table, from the delta of final_aggregation.
+    Mirrors step3_pretty_print + step4_analysis.group_by_cls/group_by_rel.
+    """
+    classified = classify_chords(delta).filter(pl.col("cls").list.len() >= 3)
+    return {
+        'final_aggregation': delta.select('notes', 'frequency', 'duration'),
+        'most_popular_rel': _merge_sums(classified, 'rel', ['cls']),
+        'most_popular_cls': _merge_sums(classified, 'cls', []),
+    }
+
+
+def merge_delta(delta: pl.DataFrame, new_files: pl.DataFrame, note: str = "", root=VERSIONS_DIR) -> int:
+    """
+    Merge an aggregated delta into the live version, producing a new version.
+    new_files is (fname, digest) of the files in the delta, as returned by ingest_delta.
+    Only partitions that contain a changed key are read and rewritten.
+    Returns the new version number.
+    """
+    parent = load_manifest(root=root)
+    version = next_version(root)
+    vdir = os.path.join(root, f"v{version}")
+    n_partitions = parent['n_partitions']
+
+    tables = {}
+    for name, delta_df in _derived_deltas(delta).items():
+        key, carry, partitioned = TABLES[name]
+        partitions = dict(parent['tables'][name]['partitions'])
+
+        if partitioned:
+            delta_parts = delta_df.with_columns(stable_bucket(key, n_partitions)).partition_by('_bucket')
+        else:
+            delta_parts = [delta_df.with_columns(pl.lit(0, pl.UInt32).alias('_bucket'))]
+
+        for delta_part in tqdm(delta_parts, desc=f"Merging {name}"):
+            bucket = str(delta_part['_bucket'][0])
+            merged = delta_part.drop('_bucket')
+            if bucket in partitions:
+                old = pl.read_parquet(os.path.join(root, partitions[bucket]))
+                merged = pl.concat([old, merged.select(old.columns)], how='vertical_relaxed')
+            merged = _merge_sums(merged, key, carry).sort('duration', descending=True)
+            os.makedirs(os.path.join(vdir, name), exist_ok=True)
+            merged.write_parquet(os.path.join(vdir, name, f"part_{bucket}.parquet"))
+            partitions[bucket] = f"v{version}/{name}/part_{bucket}.parquet"
+
+        print(f"{name}: rewrote {len(delta_parts)} of {len(partitions)} partitions")
+        tables[name] = {'key': key, 'partitions': partitions}
+
+    new_files.select('fname', 'digest').write_parquet(os.path.join(vdir, "ingested.parquet"))
+    _write_json(os.path.join(vdir, "manifest.json"), {
+        'version': version,
+        'parent': parent['version'],
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'note': note,
+        'n_partitions': n_partitions,
+        'tables': tables,
+        'ingested': parent['ingested'] + [f"v{version}/ingested.parquet"],
+    })
+    # only now does the new version go live
+    rollback(version, root)
+    return version
+
+
+def export_tables(version: int = None, root=VERSIONS_DIR, final_dir="data/chords/final"):
+    """
+    Write a version back out as the single-file tables the later steps read.
+    This is a full rewrite; only needed for consumers that cannot read the partitions.
+    """
+    for name in TABLES:
+        print(f"Exporting {name}...")
+        sort_by = 'duration' if name == 'final_aggregation' else 'frequency'
+        df = scan_table(name, version, root).sort(sort_by, descending=True).collect()
+        if name == 'most_popular_cls':
+            df = pretty_print_chords(df, col="cls", octave=False)
+        df.write_parquet(os.path.join(final_dir, f"{name}.parquet"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge a new collection of MIDI files into the final tables.")
+    parser.add_argument('midi_root', nargs='?', default="data/music")
+    parser.add_argument('--rebase', nargs=2, metavar=('OLD_ROOT', 'NEW_ROOT'),
+                        help="first run only: the full build's fragments record OLD_ROOT paths, "
+                             "the files are now readable under NEW_ROOT")
+    parser.add_argument('--memory-budget', default="16GiB")
+    args = parser.parse_args()
+
+    # one-time: turn the full-rebuild outputs into version 0
+    if not os.path.exists(os.path.join(VERSIONS_DIR, "CURRENT")):
+        fnames = pl.scan_parquet("data/fragments/*.parquet").select('fname').unique().collect()['fname']
+        init_versions(fnames.to_list(), rebase=tuple(args.rebase) if args.rebase else None)
+
+    # ingest a new collection and merge it in
+    delta_dir = f"data/fragments_delta/v{next_version()}"
+    new_files = ingest_delta(
+        midi_root=args.midi_root,
+        delta_dir=delta_dir,
+        memory_budget=args.memory_budget,
+    )
+    if new_files.height:
+        delta = aggregate_delta(delta_dir)
+        merge_delta(delta, new_files, note=args.midi_root)
+
+    # rollback(0)
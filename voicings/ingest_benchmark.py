@@ -0,0 +1,92 @@
+# Process pool vs. thread pool ingestion (collect_chords_directory_parallel, backend=...).
+
+# Both backends parse the same synthetic corpus (generated once, with a fixed seed) into fragments,
+# and for each we report:
+# - seconds: wall time of collect_chords_directory_parallel, including pool startup
+# - files_per_s
+# - rows: fragment rows written
+# The fragments of every run are checked to hold the same (fname, notes, duration) rows,
+# so the comparison is between equal outputs.
+
+# The process pool pays for spawning workers, re-importing polars and symusic in each, and
+# writing every batch through parquet; the thread pool pays for the GIL around the Python
+# chord extraction, unless the interpreter is free-threaded (python3.13t, see gil_enabled).
+
+import os
+import random
+import shutil
+import time
+
+import polars as pl
+from symusic import Note, Score, Track
+
+from voicings.cmaj7_mp import collect_chords_directory_parallel, gil_enabled, list_midi_files
+
+CHORDS = [(0, 4, 7), (0, 3, 7), (0, 4, 7, 11), (0, 4, 7, 10), (0, 3, 7, 10), (0, 5, 7), (0, 4, 8)]
+
+
+def make_corpus(root="data/benchmark/corpus", n_files=2000, seed=0):
+    """
+    n_files random chord progressions with slightly staggered onsets, in 10 directories.
+    """
+    if os.path.isdir(root) and len(list_midi_files(root)) == n_files:
+        return root
+    shutil.rmtree(root, ignore_errors=True)
+    rng = random.Random(seed)
+    for i in range(n_files):
+        directory = os.path.join(root, f"dir{i % 10}")
+        os.makedirs(directory, exist_ok=True)
+        score, track, time = Score(480), Track(), 0
+        for _ in range(rng.randint(50, 500)):
+            base, chord, duration = rng.randint(36, 60), rng.choice(CHORDS), rng.choice([240, 480, 960])
+            for pitch in chord:
+                track.notes.append(Note(time + rng.randint(0, 5), duration, base + pitch, 80))
+            time += duration
+        score.tracks.append(track)
+        score.dump_midi(os.path.join(directory, f"piece_{i}.mid"))
+    return root
+
+
+def run(corpus, backend, n_workers, batch_size, output_dir):
+    shutil.rmtree(output_dir, ignore_errors=True)
+    start = time.perf_counter()
+    collect_chords_directory_parallel(
+        corpus,
+        batch_size=batch_size,
+        n_processes=n_workers,
+        output_dir=output_dir,
+        backend=backend,
+    )
+    seconds = time.perf_counter() - start
+    rows = pl.read_parquet(f"{output_dir}/*.parquet").sort('fname', 'notes')
+    return seconds, rows
+
+
+def ingest_benchmark(corpus, workers=(1, 2, 4, 8), batch_size=100, output_dir="data/benchmark/fragments"):
+    n_files = len(list_midi_files(corpus))
+    results, reference = [], None
+    for n_workers in workers:
+        for backend in ('process', 'thread'):
+            seconds, rows = run(corpus, backend, n_workers, batch_size, output_dir)
+            if reference is None:
+                reference = rows
+            elif not rows.equals(reference):
+                raise AssertionError(f"{backend} with {n_workers} workers wrote different rows")
+            results.append({
+                'backend': backend,
+                'workers': n_workers,
+                'seconds': seconds,
+                'files_per_s': n_files / seconds,
+                'rows': rows.height,
+            })
+    shutil.rmtree(output_dir, ignore_errors=True)
+    return pl.DataFrame(results)
+
+
+if __name__ == "__main__":
+    print(f"GIL enabled: {gil_enabled()}")
+    corpus = make_corpus()
+    df = ingest_benchmark(corpus, workers=sorted({1, 2, 4, os.cpu_count()}))
+    with pl.Config(tbl_rows=-1):
+        print(df)
+    df.write_parquet("data/benchmark/ingest_benchmark.parquet")
@@ -0,0 +1,132 @@
+# Inverted index: which pieces use this voicing?
+
+# aggregate_df only keeps fname long enough to count it. This keeps it, compactly:
+# while the fragments are aggregated, each one also spills its distinct
+# (file_id, digest, pcid) triples; finalize() then turns those into posting lists.
+
+# Layout of data/chords/index/:
+# - files.txt                 file_id -> fname, one per line
+# - pcid_offsets.npy          2049 byte offsets into pcid_postings.bin
+# - pcid_postings.bin
+# - digest_keys.bin           sorted digests, concatenated
+# - digest_key_offsets.npy    byte offsets into digest_keys.bin
+# - digest_offsets.npy        byte offsets into digest_postings.bin
+# - digest_postings.bin
+# Posting lists are delta + varint encoded (see core/postings.py) and read through mmap.
+
+# Voicings are keyed by digest of 'rel' (as in the export), so all transpositions share a list.
+
+import os
+import shutil
+
+import numpy as np
+import polars as pl
+from tqdm import tqdm
+
+from voicings.core.classify import rel_expr
+from voicings.core.encipher import pack_notes, pcid_expr
+from voicings.core.postings import PostingIndex, encode_postings
+
+
+class PostingsCollector:
+    """
+    Pass to tournament_merge(postings=...) to build the index during the initial aggregation,
+    or feed it fragments directly with add_fragment.
+    """
+
+    def __init__(self, spill_dir="data/chords/index_spill"):
+        self.spill_dir = spill_dir
+        self.file_ids = {}
+        self.n_spilled = 0
+        os.makedirs(spill_dir, exist_ok=True)
+
+    def add_fragment(self, df: pl.DataFrame):
+        """
+        df: a raw fragment with columns fname, notes.
+        """
+        df = df.select('fname', 'notes').drop_nulls().unique()
+        if df.height == 0:
+            return
+
+        # files are numbered in the order they are first seen
+        fnames = df['fname'].unique(maintain_order=True).to_list()
+        for fname in fnames:
+            if fname not in self.file_ids:
+                self.file_ids[fname] = len(self.file_ids)
+        lookup = pl.DataFrame({
+            'fname': fnames,
+            'file_id': [self.file_ids[f] for f in fnames],
+        }, schema={'fname': pl.Utf8, 'file_id': pl.UInt32})
+
+        # only pack each distinct 'rel' once
+        df = df.with_columns(rel_expr('notes').alias('rel'))
+        digests = df.select('rel').unique().with_columns(
+            pl.col('rel').map_elements(lambda rel: pack_notes(list(rel)), return_dtype=pl.Utf8).alias('digest'),
+            pcid_expr('rel').alias('pcid'),
+        )
+        triples = df.join(digests, on='rel').join(lookup, on='fname').select(
+            'file_id', 'digest', 'pcid'
+        ).unique()
+        triples.write_parquet(os.path.join(self.spill_dir, f"spill_{self.n_spilled}.parquet"))
+        self.n_spilled += 1
+
+    def finalize(self, index_dir="data/chords/index") -> PostingIndex:
+        """
+        Turn the spilled triples into posting lists.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        with open(os.path.join(index_dir, "files.txt"), 'w', encoding='utf-8') as f:
+            f.write("\n".join(self.file_ids))
+
+        spilled = pl.scan_parquet(os.path.join(self.spill_dir, "*.parquet"))
+
+        print("Building PCID posting lists...")
+        pcids = spilled.select('pcid', 'file_id').unique().sort('pcid', 'file_id').collect()
+        blob, offsets = encode_postings(pcids['pcid'].to_numpy(), pcids['file_id'].to_numpy(), 2048)
+        blob.tofile(os.path.join(index_dir, "pcid_postings.bin"))
+        np.save(os.path.join(index_dir, "pcid_offsets.npy"), offsets)
+
+        print("Building voicing posting lists...")
+        pairs = spilled.filter(pl.col('digest').is_not_null()).select('digest', 'file_id').unique().sort(
+            'digest', 'file_id'
+        ).collect(engine="streaming")
+        keys = pairs['digest'].unique(maintain_order=True)
+        groups = pairs.select(pl.col('digest').rle_id()).to_series().to_numpy()
+        blob, offsets = encode_postings(groups, pairs['file_id'].to_numpy(), len(keys))
+        blob.tofile(os.path.join(index_dir, "digest_postings.bin"))
+        np.save(os.path.join(index_dir, "digest_offsets.npy"), offsets)
+
+        key_bytes = "".join(keys).encode()
+        key_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(keys.str.len_bytes().to_numpy(), out=key_offsets[1:])
+        with open(os.path.join(index_dir, "digest_keys.bin"), 'wb') as f:
+            f.write(key_bytes)
+        np.save(os.path.join(index_dir, "digest_key_offsets.npy"), key_offsets)
+
+        print(f"Indexed {len(keys)} voicings over {len(self.file_ids)} files.")
+        shutil.rmtree(self.spill_dir)
+        return PostingIndex(index_dir)
+
+
+def build_index(input_dir="data/fragments", index_dir="data/chords/index") -> PostingIndex:
+    """
+    Build the index from the fragments on their own, without running the tournament.
+    """
+    collector = PostingsCollector()
+    files = [os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith(".parquet")]
+    for path in tqdm(files, desc="Indexing fragments"):
+        collector.add_fragment(pl.read_parquet(path))
+    return collector.finalize(index_dir)
+
+
+if __name__ == "__main__":
+    import time
+
+    # or: tournament_merge("data/fragments", postings=PostingsCollector()) and finalize()
+    index = build_index()
+
+    # pieces that use both a root position Cmaj7 and a Cmaj7 with the 3rd on top
+    start = time.time()
+    file_ids = index.query(digests=[pack_notes([0, 4, 7, 11]), pack_notes([0, 7, 11, 16])])
+    print(f"{len(file_ids)} pieces ({(time.time() - start) * 1000:.1f} ms)")
+    print(index.fnames(file_ids[:10]))
@@ -0,0 +1,62 @@
+# Chord progression statistics: bigrams and trigrams of PCIDs and of top voicings.
+
+# Workers (cmaj7_mp with transitions=True) emit one UInt64 key per n-gram, so the
+# aggregation is the same tournament as for voicings, just keyed on (kind, key).
+# The result is stored as sparse matrices:
+# - data/chords/transitions/{kind}.parquet   COO: one row per n-gram, ids decoded
+# - data/chords/transitions/{kind}_csr.npz   CSR over (previous chord, next chord), bigrams only
+
+import os
+
+import numpy as np
+import polars as pl
+
+from voicings.chord_tournament import tournament_merge
+from voicings.core.ngrams import PCID_BASE, decode_ngrams, load_voicing_vocab, to_csr
+
+
+def aggregate_transitions(input_dir="data/transitions") -> pl.DataFrame:
+    """
+    (kind, key, duration, frequency) over all transition fragments.
+    The key space is small, so nothing is pruned.
+    """
+    return tournament_merge(input_dir, prune_min_freq=None, key=['kind', 'key'])
+
+
+def write_transitions(df: pl.DataFrame, voicing_base: int = None, output_dir="data/chords/transitions"):
+    """
+    Split the aggregated n-grams by kind, decode the ids, and write COO and CSR forms.
+    voicing_base is len(voicing_vocab) + 1, if voicing n-grams were collected.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    bases = {'pcid': PCID_BASE, 'voicing': voicing_base}
+    for part in df.partition_by('kind'):
+        kind = part['kind'][0]
+        name, order = kind[:-1], int(kind[-1])
+        base = bases[name]
+
+        ids = decode_ngrams(part['key'].to_numpy(), base, order)
+        coo = part.drop('kind').with_columns(
+            pl.Series(f"{name}_{i}", ids[i]) for i in range(order)
+        ).sort('duration', descending=True)
+        coo.write_parquet(os.path.join(output_dir, f"{kind}.parquet"))
+
+        if order == 2:
+            indptr, indices, duration = to_csr(part, base, 'duration')
+            _, _, frequency = to_csr(part, base, 'frequency')
+            np.savez(
+                os.path.join(output_dir, f"{kind}_csr.npz"),
+                indptr=indptr, indices=indices, duration=duration, frequency=frequency,
+                shape=np.array([base, base]),
+            )
+        print(f"{kind}: {coo.height} distinct n-grams")
+
+
+if __name__ == "__main__":
+    # ingestion with
+    #   collect_chords_directory_parallel(..., transitions=True, voicing_vocab=load_voicing_vocab())
+    # produces data/transitions/transitions_*.parquet
+    vocab = load_voicing_vocab()
+
+    df = aggregate_transitions("data/transitions")
+    write_transitions(df, voicing_base=len(vocab) + 1)
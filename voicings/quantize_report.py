@@ -0,0 +1,82 @@
+# How much does onset quantization shrink the aggregation problem?
+
+# For every extraction setting (see all_chords_for_score: tolerance, min_duration, unit), parse the
+# same benchmark files and measure what the later stages pay for:
+# - distinct_voicings: distinct keys over all files (what the tournament / cyclic aggregation group on)
+# - rows: fragment rows, i.e. distinct (file, voicing) pairs
+# - fragment_bytes: size of those rows as parquet
+# - duration_kept: counted chord duration relative to the baseline; above 1 when snapping merges
+#   staggered onsets into chords of 3+ notes that were partly 1-2 note slivers before
+# Everything is relative to the first setting (which should be the unquantized baseline).
+# Run it on the real corpus (data/music) before picking a setting: synthetic files with random
+# onset jitter collapse far more under snapping than performed or sequenced music does, so their
+# ratios say nothing about the real shrinkage. No figures are quoted here until that run exists.
+
+import io
+import multiprocessing as mp
+
+import polars as pl
+from tqdm import tqdm
+
+from voicings.cmaj7_mp import list_midi_files, process_midi_file
+
+SETTINGS = [
+    {},
+    {'tolerance': 10},
+    {'tolerance': 30},
+    {'tolerance': 1 / 32, 'unit': 'quarters'},
+    {'tolerance': 1 / 16, 'unit': 'quarters'},
+    {'min_duration': 1 / 16, 'unit': 'quarters'},
+    {'tolerance': 1 / 32, 'min_duration': 1 / 16, 'unit': 'quarters'},
+]
+
+
+def _extract(args):
+    path, options = args
+    result = process_midi_file(path, options)
+    return result['fname'], result['notes'], result['duration']
+
+
+def measure(midi_files: list[str], options: dict, n_processes: int = None) -> dict:
+    collector = {'fname': [], 'notes': [], 'duration': []}
+    with mp.get_context("spawn").Pool(n_processes or mp.cpu_count()) as pool:
+        for fnames, notes, durations in pool.imap_unordered(_extract, [(f, options) for f in midi_files], chunksize=8):
+            collector['fname'].extend(fnames)
+            collector['notes'].extend(notes)
+            collector['duration'].extend(durations)
+
+    df = pl.DataFrame(collector, schema={
+        'fname': pl.Utf8,
+        'notes': pl.List(pl.Int32),
+        'duration': pl.Float64,
+    }).group_by('fname', 'notes').agg(pl.col('duration').sum())
+
+    buffer = io.BytesIO()
+    df.write_parquet(buffer)
+    return {
+        'setting': str(options) if options else "baseline",
+        'distinct_voicings': df['notes'].n_unique(),
+        'rows': df.height,
+        'fragment_bytes': buffer.tell(),
+        'duration': df['duration'].sum(),
+    }
+
+
+def quantize_report(midi_files: list[str], settings=SETTINGS, n_processes: int = None) -> pl.DataFrame:
+    rows = [measure(midi_files, options, n_processes) for options in tqdm(settings, desc="Settings")]
+    df = pl.DataFrame(rows)
+    baseline = df.row(0, named=True)
+    return df.with_columns(
+        (pl.col('distinct_voicings') / baseline['distinct_voicings']).alias('distinct_ratio'),
+        (pl.col('rows') / baseline['rows']).alias('rows_ratio'),
+        (pl.col('fragment_bytes') / baseline['fragment_bytes']).alias('bytes_ratio'),
+        (pl.col('duration') / baseline['duration']).alias('duration_kept'),
+    ).drop('duration')
+
+
+if __name__ == "__main__":
+    midi_files = list_midi_files("data/music")
+    df = quantize_report(midi_files)
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, fmt_str_lengths=80):
+        print(df)
+    df.write_parquet("data/chords/quantize_report.parquet")
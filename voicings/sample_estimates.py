@@ -0,0 +1,90 @@
+# Sampling mode: most_popular_cls / most_popular_rel estimated from a stratified sample of files.
+
+# Instead of ingesting and aggregating the full corpus:
+#   collect_chords_directory_parallel(..., sample_fraction=0.02, output_dir="data/sample/fragments")
+# parses a reproducible stratified sample and writes its design to data/sample/design.parquet.
+# The sample is small, so its fragments are read in one go (no tournament needed), and every
+# row of the full tables gets an estimate of its total with a confidence interval:
+# - data/sample/most_popular_cls.parquet
+# - data/sample/most_popular_rel.parquet
+# frequency and duration are estimates of the full-corpus values; *_lo / *_hi bound them.
+
+import os
+
+import polars as pl
+
+from voicings.core.classify import rel_expr
+from voicings.core.decipher import pretty_print_chords
+from voicings.core.sampling import bootstrap_totals, stratified_totals
+
+
+def per_file_chords(fragments_dir="data/sample/fragments") -> pl.DataFrame:
+    """
+    (fname, notes, rel, cls, duration) with one row per distinct voicing in each sampled file.
+    """
+    df = pl.scan_parquet(os.path.join(fragments_dir, "*.parquet")).filter(
+        pl.col('notes').is_not_null()
+    ).group_by('fname', 'notes').agg(
+        pl.col('duration').sum()
+    ).with_columns(
+        rel_expr('notes').alias('rel'),
+    ).with_columns(
+        pl.col('rel').list.eval(pl.element() % 12).list.unique().list.sort().alias('cls'),
+    ).filter(
+        pl.col('cls').list.len() >= 3
+    )
+    return df.collect()
+
+
+def estimate_table(chords: pl.DataFrame, design: pl.DataFrame, key: str, method='analytical', **kwargs) -> pl.DataFrame:
+    """
+    Estimated (frequency, duration) per key, where frequency counts (file, voicing) pairs
+    exactly like group_by_cls / group_by_rel do on the full aggregation.
+    method is 'analytical' (normal approximation) or 'bootstrap'; kwargs go to the estimator.
+    """
+    per_file = chords.group_by('fname', key).agg(
+        pl.len().cast(pl.Float64).alias('frequency'),
+        pl.col('duration').sum(),
+    )
+    if method == 'analytical':
+        df = stratified_totals(per_file, design, key, ['frequency', 'duration'], **kwargs)
+    elif method == 'bootstrap':
+        df = bootstrap_totals(per_file, design, key, ['frequency', 'duration'], **kwargs)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+    return df.select(
+        key,
+        'frequency', 'frequency_lo', 'frequency_hi',
+        'duration', 'duration_lo', 'duration_hi',
+    ).sort('frequency', descending=True)
+
+
+def estimate_cls_rel(
+        fragments_dir="data/sample/fragments",
+        design_path="data/sample/design.parquet",
+        output_dir="data/sample",
+        method='analytical',
+        **kwargs
+    ):
+    design = pl.read_parquet(design_path)
+    chords = per_file_chords(fragments_dir)
+    print(f"{chords.height} (file, voicing) pairs in {design.height} sampled files")
+
+    cls = estimate_table(chords, design, 'cls', method, **kwargs)
+    cls = pretty_print_chords(cls, col="cls", octave=False)
+    cls.write_parquet(os.path.join(output_dir, "most_popular_cls.parquet"))
+
+    rel = estimate_table(chords, design, 'rel', method, **kwargs).join(
+        chords.select('rel', 'cls').unique(subset='rel'), on='rel', how='left'
+    )
+    rel.write_parquet(os.path.join(output_dir, "most_popular_rel.parquet"))
+
+    print("Estimated top chord classes:")
+    print(cls.head(20))
+
+
+if __name__ == "__main__":
+    # first, e.g.
+    #   collect_chords_directory_parallel(midi_root, sample_fraction=0.02, sample_strata='directory',
+    #                                     output_dir="data/sample/fragments")
+    estimate_cls_rel()
@@ -0,0 +1,342 @@
+# Multi-host ingestion against a shared directory.
+
+# One box running cmaj7_mp is CPU-bound on a million-plus MIDI files. Instead, any number of
+# hosts can each run a worker against a shared directory (NFS, SMB, ...):
+
+# shared/
+#     manifest.json             n_shards
+#     manifest.parquet          relative path -> shard (crc32 of the path, so it is deterministic)
+#     leases/shard_{i}.lease    claimed by a worker; its beat counter is bumped while it works
+#     done/shard_{i}.done       written after all of the shard's fragments are on disk
+#     fragments/fragment_s{i}_{token}_{batch}.parquet
+#     quarantine/shard_{i}.parquet
+
+# A lease whose beat counter has not moved for lease_timeout (on the observer's own clock)
+# belongs to a dead worker and can be stolen.
+# Every lease holds its owner's token; a worker only heartbeats or removes a lease with its own token.
+# A worker that finds its lease gone stops before its next batch and writes no done marker.
+# A shard's fragments are cleared before it is (re-)run, so a half-finished shard is harmless
+# even if the hosts use different batch sizes; fragments carry the owner's token, and the
+# coordinator keeps only those of the token in the done marker.
+# Once every shard is done, the coordinator runs the usual tournament/refuse steps on the fragments.
+
+# Try it on one machine:
+#   python -m voicings.sharded_ingest manifest --shared /tmp/shared --midi-root data/music --shards 8
+#   python -m voicings.sharded_ingest worker --shared /tmp/shared --midi-root data/music --processes 2 &
+#   python -m voicings.sharded_ingest worker --shared /tmp/shared --midi-root data/music --processes 2 &
+#   python -m voicings.sharded_ingest coordinator --shared /tmp/shared
+
+import argparse
+import glob
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+
+import polars as pl
+
+from voicings.chord_tournament import main_refuse_step, main_tournament_step
+from voicings.cmaj7_mp import IngestionCancelled, collect_chords_directory_parallel, list_midi_files
+
+
+def shard_of(relpath: str, n_shards: int) -> int:
+    # not hash(): that is salted per process
+    return zlib.crc32(relpath.replace(os.sep, "/").encode()) % n_shards
+
+
+def write_manifest(shared_dir: str, midi_root: str, n_shards: int):
+    files = [os.path.relpath(f, midi_root) for f in list_midi_files(midi_root)]
+    df = pl.DataFrame({'fname': files}, schema={'fname': pl.Utf8}).with_columns(
+        pl.col('fname').map_elements(lambda f: shard_of(f, n_shards), return_dtype=pl.Int32).alias('shard')
+    )
+    for sub in ("leases", "done", "fragments", "quarantine"):
+        os.makedirs(os.path.join(shared_dir, sub), exist_ok=True)
+    df.write_parquet(os.path.join(shared_dir, "manifest.parquet"))
+    with open(os.path.join(shared_dir, "manifest.json"), 'w') as f:
+        json.dump({'n_shards': n_shards}, f)
+    print(f"Manifest: {df.height} files in {n_shards} shards.")
+
+
+def _n_shards(shared_dir):
+    with open(os.path.join(shared_dir, "manifest.json")) as f:
+        return json.load(f)['n_shards']
+
+
+def _lease_path(shared_dir, shard):
+    return os.path.join(shared_dir, "leases", f"shard_{shard}.lease")
+
+
+def _done_path(shared_dir, shard):
+    return os.path.join(shared_dir, "done", f"shard_{shard}.done")
+
+
+def _read_lease(path) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        # created but not written yet
+        return {}
+
+
+def _beat_of(lease: dict):
+    return (lease.get('token'), lease.get('beat'))
+
+
+def _steal_if_stale(path: str, lease_timeout: float, observed: dict):
+    """
+    Move a stale lease out of the way. A lease is stale once its heartbeat counter has not moved
+    for lease_timeout seconds of *this* host's clock, as seen across calls (observed remembers
+    what was seen and when). No host's clock is compared with another's, or with the file
+    server's mtimes, so clock skew cannot make a live lease look stale.
+
+    Two stealers can both see the same stale lease, and the slower one may then rename the
+    faster one's fresh lease instead; so check what was renamed and put it back if it is not
+    the stale lease that was read.
+    """
+    seen = _read_lease(path)
+    if not seen:
+        # no lease, or one being written right now
+        observed.pop(path, None)
+        return
+    now = time.monotonic()
+    if path not in observed or observed[path][0] != _beat_of(seen):
+        observed[path] = (_beat_of(seen), now)
+        return
+    if now - observed[path][1] <= lease_timeout:
+        return
+
+    moved = f"{path}.stale.{uuid.uuid4().hex}"
+    try:
+        os.rename(path, moved)
+    except FileNotFoundError:
+        return
+    del observed[path]
+    if _beat_of(_read_lease(moved) or {}) == _beat_of(seen):
+        os.remove(moved)
+        return
+    try:
+        # link, not rename: never clobber a lease created in the meantime
+        os.link(moved, path)
+    except FileExistsError:
+        pass
+    os.remove(moved)
+
+
+def _lease_record(owner, token, beat):
+    return json.dumps({'owner': owner, 'token': token, 'beat': beat, 'heartbeat': time.time()})
+
+
+def try_claim(shared_dir: str, shard: int, owner: str, token: str, lease_timeout: float, observed: dict = None):
+    """
+    Atomically claim a shard; returns the lease file, kept open for the heartbeat, or None.
+    Stale leases (heartbeat counter unchanged for lease_timeout seconds) are stolen.
+    """
+    if os.path.exists(_done_path(shared_dir, shard)):
+        return None
+    path = _lease_path(shared_dir, shard)
+    _steal_if_stale(path, lease_timeout, {} if observed is None else observed)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+    except FileExistsError:
+        return None
+    lease = os.fdopen(fd, 'r+')
+    lease.write(_lease_record(owner, token, 0))
+    lease.flush()
+    return lease
+
+
+def _owns(path, token) -> bool:
+    lease = _read_lease(path)
+    return lease is not None and lease.get('token') == token
+
+
+def _heartbeat(lease, path, owner, token, interval, stop: threading.Event, lost: threading.Event):
+    """
+    Bump the beat counter every interval seconds, through the open lease file: if the lease was
+    stolen (renamed away), the writes land in the old file and never clobber the new owner's.
+    Sets lost as soon as the lease at path is no longer ours.
+    """
+    beat = 0
+    while not stop.wait(interval):
+        if not _owns(path, token):
+            lost.set()
+            return
+        beat += 1
+        lease.seek(0)
+        lease.write(_lease_record(owner, token, beat))
+        lease.truncate()
+        lease.flush()
+        os.fsync(lease.fileno())
+
+
+def _clear_fragments(fragments_dir, shard):
+    # the underscore keeps shard 1 from matching shard 10's fragments
+    for f in glob.glob(os.path.join(fragments_dir, f"fragment_s{shard}_*.parquet")):
+        os.remove(f)
+
+
+def _write_done(shared_dir, shard, record):
+    tmp = f"{_done_path(shared_dir, shard)}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp, _done_path(shared_dir, shard))
+
+
+def _fenced_fragments(shared_dir, shard):
+    """
+    The fragments of the owner that wrote the shard's done marker; anything else under the
+    shard's prefix is from a worker that lost its lease.
+    """
+    with open(_done_path(shared_dir, shard)) as f:
+        token = json.load(f)['token']
+    pattern = os.path.join(shared_dir, "fragments", f"fragment_s{shard}_*.parquet")
+    prefix = os.path.join(shared_dir, "fragments", f"fragment_s{shard}_{token}_")
+    stray = [f for f in glob.glob(pattern) if not f.startswith(prefix)]
+    return stray
+
+
+def run_worker(
+        shared_dir: str,
+        midi_root: str,
+        owner: str = None,
+        lease_timeout: float = 600,
+        poll: float = 10,
+        **kwargs
+    ):
+    """
+    Claim and ingest shards until every shard is done. kwargs go to collect_chords_directory_parallel.
+    """
+    owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+    token = uuid.uuid4().hex
+    n_shards = _n_shards(shared_dir)
+    manifest = pl.read_parquet(os.path.join(shared_dir, "manifest.parquet"))
+    files_by_shard = {
+        part['shard'][0]: part['fname'].to_list() for part in manifest.partition_by('shard')
+    }
+    # start at a different shard on every worker to avoid fighting over the same leases
+    order = [(shard_of(owner, n_shards) + i) % n_shards for i in range(n_shards)]
+
+    observed = {}
+
+    while True:
+        remaining = [s for s in order if not os.path.exists(_done_path(shared_dir, s))]
+        if not remaining:
+            break
+        shard, lease = None, None
+        for s in remaining:
+            lease = try_claim(shared_dir, s, owner, token, lease_timeout, observed)
+            if lease is not None:
+                shard = s
+                break
+        if shard is None:
+            # everything left is leased by someone else; wait in case a lease goes stale
+            time.sleep(poll)
+            continue
+
+        print(f"[{owner}] claimed shard {shard}")
+        path = _lease_path(shared_dir, shard)
+        stop, lost = threading.Event(), threading.Event()
+        beat = threading.Thread(
+            target=_heartbeat, args=(lease, path, owner, token, lease_timeout / 4, stop, lost), daemon=True
+        )
+        beat.start()
+
+        def keep_going():
+            return not lost.is_set() and _owns(path, token)
+
+        try:
+            fragments_dir = os.path.join(shared_dir, "fragments")
+            _clear_fragments(fragments_dir, shard)
+            files = [os.path.join(midi_root, f) for f in files_by_shard.get(shard, [])]
+            if files:
+                collect_chords_directory_parallel(
+                    midi_root,
+                    midi_files=files,
+                    output_dir=fragments_dir,
+                    quarantine_path=os.path.join(shared_dir, "quarantine", f"shard_{shard}.parquet"),
+                    # the token fences off fragments of an earlier owner that kept writing
+                    batch_prefix=f"s{shard}_{token}_",
+                    keep_going=keep_going,
+                    **kwargs
+                )
+            if not keep_going():
+                raise IngestionCancelled("lease lost before the done marker")
+            _write_done(shared_dir, shard, {'owner': owner, 'token': token, 'files': len(files), 'finished': time.time()})
+            print(f"[{owner}] finished shard {shard}")
+        except IngestionCancelled:
+            # the new owner re-runs the shard; no done marker from here
+            print(f"[{owner}] lost the lease on shard {shard}, abandoning it")
+        finally:
+            stop.set()
+            beat.join()
+            lease.close()
+            if _owns(path, token):
+                os.remove(path)
+
+
+def run_coordinator(shared_dir: str, poll: float = 10):
+    """
+    Wait for every shard, then merge all shard fragments with the usual aggregation.
+    """
+    n_shards = _n_shards(shared_dir)
+    while True:
+        done = sum(os.path.exists(_done_path(shared_dir, s)) for s in range(n_shards))
+        print(f"{done}/{n_shards} shards done")
+        if done == n_shards:
+            break
+        time.sleep(poll)
+
+    stray = [f for s in range(n_shards) for f in _fenced_fragments(shared_dir, s)]
+    for f in stray:
+        os.remove(f)
+    if stray:
+        print(f"Removed {len(stray)} fragments written by workers that lost their lease")
+
+    fragments = os.path.join(shared_dir, "fragments")
+    # produces data/chords/summary_tournament.parquet
+    main_tournament_step(input_dir=fragments)
+    # produces data/chords/frequent_refuse.parquet and data/chords/infrequent_refuse.parquet
+    main_refuse_step(input_dir=fragments)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded MIDI ingestion over a shared directory.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("manifest")
+    p.add_argument("--shared", required=True)
+    p.add_argument("--midi-root", required=True)
+    p.add_argument("--shards", type=int, default=256)
+
+    p = sub.add_parser("worker")
+    p.add_argument("--shared", required=True)
+    p.add_argument("--midi-root", required=True, help="where this host mounts the MIDI files")
+    p.add_argument("--processes", type=int, default=None)
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.add_argument("--lease-timeout", type=float, default=600)
+    p.add_argument("--poll", type=float, default=10)
+
+    p = sub.add_parser("coordinator")
+    p.add_argument("--shared", required=True)
+    p.add_argument("--poll", type=float, default=10)
+
+    args = parser.parse_args()
+    if args.command == "manifest":
+        write_manifest(args.shared, args.midi_root, args.shards)
+    elif args.command == "worker":
+        run_worker(
+            args.shared,
+            args.midi_root,
+            lease_timeout=args.lease_timeout,
+            poll=args.poll,
+            n_processes=args.processes,
+            batch_size=args.batch_size,
+        )
+    else:
+        run_coordinator(args.shared, poll=args.poll)
@@ -1,33 +1,44 @@
 import polars as pl
 
-def collect_final_aggregation():
+CYCLIC_FNAMES = (
+    "data/chords/summary_tournament.parquet",
+    "data/chords/frequent_refuse.parquet",
+    "data/chords/cyclic-1/agg_step_0.parquet",
+    "data/chords/cyclic-1/agg_step_1.parquet",
+    "data/chords/cyclic-1/agg_step_2.parquet",
+    "data/chords/cyclic-1/agg_step_3.parquet",
+    "data/chords/cyclic-1/agg_step_4.parquet",
+    "data/chords/cyclic-2/agg_step_0.parquet",
+)
+
+# output of cyclic_agg_tournament.sketch_singleton_elimination
+SKETCH_FNAMES = (
+    "data/chords/summary_tournament.parquet",
+    "data/chords/frequent_refuse.parquet",
+    "data/chords/sketch/agg_step_0.parquet",
+)
+
+def collect_final_aggregation(fnames=None, key='notes', sketch=True):
     # Collect all the data into one df
+    if fnames is None:
+        # sketch: whichever mode cyclic_agg_tournament ran in (its USE_SKETCH)
+        fnames = SKETCH_FNAMES if sketch else CYCLIC_FNAMES
 
     collector = []
 
-    fnames = (
-        "data/chords/summary_tournament.parquet",
-        "data/chords/frequent_refuse.parquet",
-        "data/chords/cyclic-1/agg_step_0.parquet",
-        "data/chords/cyclic-1/agg_step_1.parquet",
-        "data/chords/cyclic-1/agg_step_2.parquet",
-        "data/chords/cyclic-1/agg_step_3.parquet",
-        "data/chords/cyclic-1/agg_step_4.parquet",
-        "data/chords/cyclic-2/agg_step_0.parquet",
-    )
-
     for fname in fnames:
-        print(f"Reading {fname}...")
-        df = pl.read_parquet(fname)
-        collector.append(df)
-    
-    return pl.concat(collector, how='vertical_relaxed').group_by('notes').agg(
+        print(f"Scanning {fname}...")
+        collector.append(pl.scan_parquet(fname))
+
+    # streaming: only the aggregated result is ever held in memory, so no memory budget to plan
+    return pl.concat(collector, how='vertical_relaxed').group_by(key).agg(
         pl.col('duration').sum().alias('duration'),
         pl.col('frequency').sum().alias('frequency')
-    ).sort('duration', descending=True)
+    ).sort('duration', descending=True).collect(engine="streaming")
 
 if __name__ == "__main__":
-    df = collect_final_aggregation()
+    # sketch=False if cyclic_agg_tournament ran with USE_SKETCH = False
+    df = collect_final_aggregation(sketch=True)
     print("Writing final aggregation to file...")
     df.write_parquet("data/chords/final/final_aggregation.parquet")
     print("Done.")
\ No newline at end of file
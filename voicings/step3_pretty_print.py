@@ -2,6 +2,7 @@ import polars as pl
 
 from voicings.core.classify import classify_chords, untranspose_chords
 from voicings.core.decipher import pretty_print_chords
+from voicings.core.intern import VoicingDictionary
 
 if __name__ == "__main__":
     # Load the final aggregation DataFrame
@@ -9,6 +10,10 @@ if __name__ == "__main__":
     # It should contain the final chord data we want to pretty print
     df = pl.read_parquet("data/chords/final/final_aggregation.parquet")
 
+    # interned pipeline: decode voicing ids back to notes only now
+    if 'voicing_id' in df.columns:
+        df = VoicingDictionary().decode(df)
+
     df = classify_chords(df)
     df = pretty_print_chords(df)
 
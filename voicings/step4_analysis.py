@@ -1,21 +1,60 @@
 
+import os
+
 import polars as pl
-import seaborn as sns
-import matplotlib.pyplot as plt
+from tqdm import tqdm
 
 from voicings.core.decipher import pretty_print_chords
+from voicings.core.encipher import pcid_expr
+
+ROLLUPS_DIR = "data/chords/final/rollups"
+
+# name: group-by keys. All rollups carry frequency, duration and n_voicings (number of distinct voicings).
+# 'cube' is small enough to slice further: by bass, note count or span alone is one more group_by on it.
+ROLLUPS = {
+    'cls': ['cls', 'pcid'],
+    'rel': ['rel', 'cls'],
+    'cube': ['pcid', 'bass', 'n_notes', 'span'],
+}
+
+
+def _rollup(df, keys):
+    return df.group_by(keys).agg(
+        pl.col("frequency").sum().alias("frequency"),
+        pl.col("duration").sum().alias("duration"),
+        pl.col("n_voicings").sum().alias("n_voicings"),
+    )
+
+
+def build_rollups(path="data/chords/final/final_aggregation_rel.parquet", output_dir=ROLLUPS_DIR):
+    """
+    Materialize every rollup in ROLLUPS from the base table, each with one scan -> group_by -> sink
+    on the streaming engine, so neither the table nor the per-chunk partial sums are held in memory.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    lf = pl.scan_parquet(path).select("rel", "cls", "bass", "frequency", "duration").with_columns(
+        pcid_expr("cls").alias("pcid"),
+        pl.col("rel").list.len().alias("n_notes"),
+        pl.col("rel").list.max().alias("span"),
+        pl.lit(1, pl.UInt32).alias("n_voicings"),
+    )
+    for name, keys in tqdm(ROLLUPS.items(), desc="Building rollups"):
+        out = os.path.join(output_dir, f"{name}.parquet")
+        _rollup(lf, keys).sort("frequency", descending=True).sink_parquet(out)
+        print(f"Rollup {name}: {pl.scan_parquet(out).select(pl.len()).collect().item()} rows")
+
+
+def read_rollup(name, output_dir=ROLLUPS_DIR) -> pl.LazyFrame:
+    return pl.scan_parquet(os.path.join(output_dir, f"{name}.parquet"))
+
 
 def group_by_cls():
     """
     Group DataFrame by 'cls', considering only those with >=3 unique pitch classes.
     """
-    df = pl.scan_parquet("data/chords/final/final_aggregation_rel.parquet")
-    df = df.filter(
+    df = read_rollup("cls").filter(
         pl.col("cls").list.len() >= 3
-    ).group_by("cls").agg(
-        pl.col("frequency").sum().alias("frequency"),
-        pl.col("duration").sum().alias("duration")
-    ).sort("frequency", descending=True).collect()
+    ).select("cls", "frequency", "duration").sort("frequency", descending=True).collect()
     print("Grouped by cls with >=3 unique pitch classes")
     df = pretty_print_chords(df, col="cls", octave=False)
     df.write_parquet("data/chords/final/most_popular_cls.parquet")
@@ -24,14 +63,9 @@ def group_by_rel():
     """
     Group DataFrame by 'rel', considering only those with >=3 unique pitch classes.
     """
-    df = pl.scan_parquet("data/chords/final/final_aggregation_rel.parquet")
-    df = df.filter(
+    df = read_rollup("rel").filter(
         pl.col("cls").list.len() >= 3
-    ).group_by("rel").agg(
-        pl.col("frequency").sum().alias("frequency"),
-        pl.col("duration").sum().alias("duration"),
-        pl.col("cls").first().alias("cls")
-    ).sort("frequency", descending=True).collect()
+    ).select("rel", "frequency", "duration", "cls").sort("frequency", descending=True).collect()
     print("Grouped by rel with >=3 unique pitch classes")
     # df = pretty_print_chords(df, col="rel", octave=False)
     df.write_parquet("data/chords/final/most_popular_rel.parquet")
@@ -40,16 +74,16 @@ def hard_analysis():
     """
     The meat of the analysis.
     """
-
-    df = pl.read_parquet("data/chords/final/final_aggregation_rel.parquet")
-    df = df.select("notes_str", "rel", "cls", "frequency", "duration")
+    # plotting only: the rollups and group_bys above should not need seaborn installed
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
     # Get the 20 most common cls values
-    top_cls = (df
-               .group_by("cls")
-               .agg(pl.col("frequency").sum().alias("total_frequency"))
+    top_cls = (read_rollup("cls")
+               .select("cls", pl.col("frequency").alias("total_frequency"))
                .sort("total_frequency", descending=True)
-               .head(20))
+               .head(20)
+               .collect())
     
     # Convert to pandas for seaborn
     top_cls_pd = top_cls.to_pandas()
@@ -71,6 +105,8 @@ def hard_analysis():
     print(top_cls)
 
 if __name__ == "__main__":
+    # one pass over final_aggregation_rel.parquet; everything below reads the rollups
+    build_rollups()
     # hard_analysis()
     # group_by_cls()
     group_by_rel()
\ No newline at end of file
@@ -1,8 +1,19 @@
+import gzip
+import hashlib
+import json
 import polars as pl
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 
+try:
+    import zstandard
+except ImportError:
+    # .zst variants are skipped without it
+    zstandard = None
+
 from voicings.core.feasible import is_feasible
 from voicings.core.encipher import pack_notes, pl_add_digest, pl_add_pcid, unpack_notes
 
@@ -49,34 +60,115 @@ def encipher_chords():
 
 
 
-def desperate_measures(df):
+def _write_atomic(path, data: bytes):
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _export_shard(subset: pl.DataFrame, pcid: int, output_dir: str, old: dict, compress: tuple) -> tuple[dict, bool]:
+    """
+    Write one shard (and its compressed variants) unless its content hash is unchanged.
+    Returns (manifest entry, whether anything was written).
+    """
+    data = subset.drop('pcid').write_csv().encode()
+    entry = {
+        'rows': subset.height,
+        'bytes': len(data),
+        'blake2b': hashlib.blake2b(data, digest_size=16).hexdigest(),
+        'files': [f"{pcid}.csv"],
+    }
+    variants = {}
+    if 'gz' in compress:
+        variants[f"{pcid}.csv.gz"] = lambda: gzip.compress(data, compresslevel=9, mtime=0)
+    if 'zst' in compress and zstandard is not None:
+        variants[f"{pcid}.csv.zst"] = lambda: zstandard.ZstdCompressor(level=19).compress(data)
+    entry['files'] += list(variants)
+
+    unchanged = (
+        old is not None
+        and old['blake2b'] == entry['blake2b']
+        and old['files'] == entry['files']
+        and all(os.path.exists(os.path.join(output_dir, f)) for f in entry['files'])
+    )
+    if unchanged:
+        return old, False
+
+    _write_atomic(os.path.join(output_dir, f"{pcid}.csv"), data)
+    for fname, make in variants.items():
+        _write_atomic(os.path.join(output_dir, fname), make())
+    return entry, True
+
+
+def desperate_measures(df, output_dir="data/chords/grouped", n_threads=8, compress=('gz', 'zst')):
     """
     I'm a little awed by how difficult it actually is to set up a database for a csv of only 175 MB.
     What if we just serve a lot of CSV files instead? lol
+
+    One {pcid}.csv per PCID, plus {pcid}.csv.gz / {pcid}.csv.zst for the CDN, written by n_threads
+    threads (compression and file I/O release the GIL). {output_dir}/manifest.json records the rows,
+    size and BLAKE2b hash of every shard; shards whose content did not change are not rewritten,
+    and any other shard files in output_dir (PCIDs that disappeared, or an export from before
+    the manifest) are deleted. A PCID whose voicings are all filtered out still gets a
+    header-only shard, so the client sees an empty list rather than a 404.
     """
 
     # df = pl.read_parquet("data/chords/export/most_popular_rel_packed.parquet")
+    pcids = df['pcid'].unique().sort().to_list()
 
-    os.makedirs("data/chords/grouped", exist_ok=True)
-    for subset in tqdm(df.partition_by("pcid")):
-        pcid = subset['pcid'][0]
-
-        # require >= 5 instances
-        # if subset.height > 10000:
-        subset = subset.filter(pl.col('frequency') >= 5)
-
-        if subset.height > 10000:
-            subset = subset.filter(pl.col('frequency') >= 10)
-        
+    # require >= 5 instances
+    df = df.filter(pl.col('frequency') >= 5)
+    # shards that are still over 10000 rows require >= 10
+    df = df.filter(
+        (pl.len().over('pcid') <= 10000) | (pl.col('frequency') >= 10)
+    )
+    # with feasibiltiy criterion: 178 MB -> 125 MB
+    # (once over the whole table rather than per shard)
+    df = df.filter(
+        pl.col('digest').map_elements(
+            is_feasible,
+            return_dtype=pl.Boolean
+        )
+    )
 
-        # with feasibiltiy criterion: 178 MB -> 125 MB
-        subset = subset.filter(
-            pl.col('digest').map_elements(
-                is_feasible,
-                return_dtype=pl.Boolean
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    old_shards = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            old_shards = json.load(f)['shards']
+
+    subsets = df.partition_by("pcid", as_dict=True)
+    shards = {}
+    n_written = 0
+    with ThreadPoolExecutor(n_threads) as pool:
+        futures = {
+            pcid: pool.submit(
+                _export_shard, subsets.get((pcid,), df.clear()), pcid, output_dir, old_shards.get(str(pcid)), compress
             )
-        )
-        subset.drop('pcid').write_csv(f"data/chords/grouped/{pcid}.csv")
+            for pcid in pcids
+        }
+        for pcid, future in tqdm(futures.items(), desc="Exporting shards"):
+            entry, written = future.result()
+            shards[str(pcid)] = entry
+            n_written += written
+
+    # not just the old manifest's files: the first run has no manifest to go by
+    keep = {fname for entry in shards.values() for fname in entry['files']}
+    stale = [
+        fname for fname in os.listdir(output_dir)
+        if re.fullmatch(r"\d+\.csv(\.gz|\.zst)?", fname) and fname not in keep
+    ]
+    for fname in stale:
+        os.remove(os.path.join(output_dir, fname))
+
+    _write_atomic(manifest_path, json.dumps({
+        'rows': sum(e['rows'] for e in shards.values()),
+        'shards': dict(sorted(shards.items(), key=lambda kv: int(kv[0]))),
+    }, indent=2).encode())
+    print(f"Exported {len(shards)} shards: {n_written} rewritten, {len(shards) - n_written} unchanged, "
+          f"{len(stale)} stale files removed.")
 
 
 if __name__ == "__main__":